@@ -51,6 +51,180 @@ cat SomeFile.txt | python egrep.py "[0-9]" | python line_count.py
 # The | is the pipe character, which means "use the output of the left command as
 # the input of the right command." You can build pretty elaborate data-processing
 # pipelines this way.
+#
+# These scripts are fine for small inputs, but they do a lot of work per line: egrep.py
+# looks up its regex in the re module's cache for every line (re.search(regex, line)
+# is really re.compile(regex).search(line)), and makes a separate sys.stdout.write
+# call for every match. On big log files that's much slower than the disk.
+#
+# A faster version compiles the regex once, reads its input in big binary blocks, and
+# searches each block as a whole: when the regex finds a match, it outputs the line
+# containing it and resumes searching at the start of the next line. (The regex is
+# compiled with re.MULTILINE so that ^ and $ still match at the start and end of
+# each line. A match could stray across a newline, say with [^x], so we check each
+# candidate line again on its own. Patterns that can look outside the current line,
+# \A, \Z and lookarounds, just get checked against every line.) If the pattern has
+# no special characters at all, we skip the regex entirely and look for the string
+# with bytes.find. And we collect each block's matching lines and write them all
+# at once:
+
+# egrep_fast.py
+import sys, re
+
+REGEX_SPECIAL_CHARACTERS = set(bytearray(b".^$*+?{}[]\\|()"))
+# anchors and lookarounds, which would see past the line when searching a block
+LINE_ONLY_TOKENS = [b"\\A", b"\\Z", b"(?<", b"(?=", b"(?!"]
+
+def matching_lines(buffer, end, pattern, regex, line_regex):
+    """the complete lines in buffer[:end] that line_regex matches, found by
+    searching for pattern (if regex is None) or regex across the whole buffer"""
+    lines = []
+    position = 0
+    while position < end:
+        if regex is None:
+            start = buffer.find(pattern, position, end)
+        else:
+            match = regex.search(buffer, position, end)
+            start = match.start() if match else -1
+        if start < 0:
+            break
+
+        # expand the match out to the line that contains it
+        previous_newline = buffer.rfind(b"\n", position, start)
+        line_start = previous_newline + 1 if previous_newline >= 0 else position
+        next_newline = buffer.find(b"\n", start, end)
+        line_end = next_newline + 1 if next_newline >= 0 else end
+
+        line = buffer[line_start:line_end]
+        if regex is None or line_regex.search(line):
+            lines.append(line)
+        position = line_end
+    return lines
+
+def fast_egrep(pattern, infile, outfile, block_size=1024 * 1024):
+    """writes the lines of infile (a binary file) that match pattern to outfile"""
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode('utf-8')
+
+    line_regex = re.compile(pattern)
+    if not REGEX_SPECIAL_CHARACTERS.intersection(bytearray(pattern)):
+        regex = None                                      # plain string search
+    elif any(token in pattern for token in LINE_ONLY_TOKENS):
+        regex = re.compile(b"^", re.MULTILINE)            # check every line
+    else:
+        regex = re.compile(pattern, re.MULTILINE)
+
+    leftover = b""
+    while True:
+        block = infile.read(block_size)
+        buffer = leftover + block
+        # only search complete lines, unless we're at the end of the input
+        end = buffer.rfind(b"\n") + 1 if block else len(buffer)
+        outfile.write(b"".join(matching_lines(buffer, end, pattern, regex, line_regex)))
+        leftover = buffer[end:]
+        if not block:
+            break
+
+fast_egrep(sys.argv[1],
+           getattr(sys.stdin, 'buffer', sys.stdin),      # read bytes, not text
+           getattr(sys.stdout, 'buffer', sys.stdout))
+
+# To see how much faster it is, we can time both approaches on the same generated
+# log file, writing the output to nowhere:
+
+# egrep_benchmark.py
+import os, random, re, time
+
+with open('benchmark.log', 'wb') as f:
+    for i in range(2000000):
+        f.write(b"2014-11-%02d 12:%02d:00 user%d GET /page/%d status=%d\n" %
+                (i % 28 + 1, i % 60, random.randrange(10000),
+                 random.randrange(1000), random.choice([200, 200, 200, 404, 500])))
+
+megabytes = os.path.getsize('benchmark.log') / 1e6
+
+for pattern in ["status=500", "user1[0-9]* GET"]:
+    start = time.time()
+    with open('benchmark.log', 'rb') as f, open(os.devnull, 'wb') as out:
+        for line in f:
+            if re.search(pattern.encode('utf-8'), line):
+                out.write(line)
+    print pattern, "egrep.py:", megabytes / (time.time() - start), "MB/s"
+
+    start = time.time()
+    with open('benchmark.log', 'rb') as f, open(os.devnull, 'wb') as out:
+        fast_egrep(pattern, f, out)
+    print pattern, "egrep_fast.py:", megabytes / (time.time() - start), "MB/s"
+
+# line_count.py has the same problem: the Python loop runs once per line, when all
+# we really need to do is count newline characters, which bytes.count does at C
+# speed. Given file names, line_count_fast.py memory-maps each file (so the
+# operating system pages it in without our copying it around), counts the newlines
+# a big chunk at a time, and for big files, splits the file into byte ranges and
+# counts them in parallel. Given no file names, it falls back to reading stdin in
+# big blocks. Either way, a last line that doesn't end in a newline still counts,
+# just like it does for line_count.py.
+
+# line_count_fast.py
+import sys, os, mmap, multiprocessing
+
+CHUNK_SIZE = 64 * 1024 * 1024    # how much to count at once
+PARALLEL_SIZE = 256 * 1024 * 1024  # files bigger than this get split up
+
+def count_newlines(job):
+    """the number of newlines between byte offsets start and stop of path"""
+    path, start, stop = job
+    count = 0
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for chunk_start in range(start, stop, CHUNK_SIZE):
+                chunk_stop = min(chunk_start + CHUNK_SIZE, stop)
+                count += mapped[chunk_start:chunk_stop].count(b"\n")
+        finally:
+            mapped.close()
+    return count
+
+def count_file_lines(path, pool=None):
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0   # (and mmap can't map an empty file)
+
+    if pool is None or size < PARALLEL_SIZE:
+        count = count_newlines((path, 0, size))
+    else:
+        jobs = [(path, start, min(start + CHUNK_SIZE, size))
+                for start in range(0, size, CHUNK_SIZE)]
+        count = sum(pool.map(count_newlines, jobs))
+
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            count += 1     # the last line has no newline
+    return count
+
+def count_stream_lines(stream, block_size=1024 * 1024):
+    count, last_byte = 0, b"\n"
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        count += block.count(b"\n")
+        last_byte = block[-1:]
+    return count + (last_byte != b"\n")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        pool = multiprocessing.Pool()
+        print sum(count_file_lines(path, pool) for path in sys.argv[1:])
+        pool.close()
+    else:
+        print count_stream_lines(getattr(sys.stdin, 'buffer', sys.stdin))
+
+# after which you can do something like:
+
+'python line_count_fast.py huge.log'
+
 #
 # Similarly, here's a script that counts the words in its input and writes out the most
 # common ones:
@@ -81,6 +255,113 @@ for word, count in counter.most_common(num_words):
 
 'C:\DataScience>type the_bible.txt | python most_common_words.py 10'
 
+# On a big corpus most_common_words.py is stuck on one core, and its Counter has to
+# hold every distinct word. (It also makes four write calls per word it outputs,
+# which matters less, but is easy to fix.)
+#
+# Counting words splits up nicely, though: we can cut each file into byte ranges
+# that start and end on line boundaries, count the words in each range in a
+# separate process, and then add up the Counters. At the end, Counter.most_common
+# uses a heap to pull out the top num_words without sorting everything.
+#
+# If the vocabulary is too big for memory, each worker can instead feed its counts
+# into the SpaceSaving sketch from the statistics chapter, which uses a fixed
+# number of counters (and tells us how far off each count might be), and the
+# sketches can be merged just like the Counters.
+
+# most_common_words_parallel.py
+import sys, os, multiprocessing
+from collections import Counter
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+def line_aligned_ranges(path, num_ranges):
+    """split path into at most num_ranges (start, stop) byte ranges, each of which
+    starts at the beginning of a line and stops at the end of one"""
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, num_ranges):
+            f.seek(max(size * k // num_ranges, boundaries[-1]))
+            f.readline()                    # skip to the start of the next line
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return [(start, stop) for start, stop in zip(boundaries, boundaries[1:])
+            if start < stop]
+
+def read_range(path, start, stop):
+    """generator that returns blocks of whole lines from path[start:stop]"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < stop:
+            block = f.read(min(BLOCK_SIZE, stop - position))
+            if not block.endswith(b"\n") and position + len(block) < stop:
+                block += f.readline()       # finish off the last line
+            position += len(block)
+            yield block
+
+def count_words_in_range(job):
+    path, start, stop, capacity = job
+    sketch = SpaceSaving(capacity) if capacity else None
+    counts = Counter()
+    for block in read_range(path, start, stop):
+        block_counts = Counter(block.lower().split())   # split on whitespace
+        if sketch is None:
+            counts.update(block_counts)
+        else:
+            for word, count in block_counts.items():
+                sketch.add(word, count)
+    return sketch if sketch is not None else counts
+
+def count_words(paths, num_workers=None, capacity=None):
+    """a Counter of the lowercased words in paths (or, if capacity is given,
+    a SpaceSaving sketch with that many counters)"""
+    num_workers = num_workers or multiprocessing.cpu_count()
+    jobs = [(path, start, stop, capacity)
+            for path in paths
+            for start, stop in line_aligned_ranges(path, 4 * num_workers)]
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        results = pool.map(count_words_in_range, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    total = SpaceSaving(capacity) if capacity else Counter()
+    for result in results:
+        if capacity:
+            total.merge(result)
+        else:
+            total.update(result)
+    return total
+
+if __name__ == "__main__":
+    # pass in number of words as first argument, and then the files to count;
+    # add --approximate=N to use only N counters
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--approximate=")]
+    capacity = [int(arg.split("=")[1]) for arg in sys.argv[1:]
+                if arg.startswith("--approximate=")]
+    try:
+        num_words, paths = int(args[0]), args[1:]
+    except:
+        print "usage: most_common_words_parallel.py num_words [--approximate=N] file ..."
+        sys.exit(1)
+
+    counts = count_words(paths, capacity=capacity[0] if capacity else None)
+    if capacity:
+        top = [(word, count) for word, count, _ in counts.most_common(num_words)]
+    else:
+        top = counts.most_common(num_words)
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(b"".join(b"%d\t%s\n" % (count, word) for word, count in top))
+
+# after which you can do something like:
+
+'python most_common_words_parallel.py 10 the_bible.txt'
+
 ## Reading Files: 
 # You can also explicitly read from and write to files directly in your code. Python
 # makes working with files pretty simple.
@@ -136,6 +417,96 @@ with open('email_address.txt', 'r') as f:
                             for line in f
                             if "@" in line)
 
+# This "extract a key from each line and count the keys" pattern comes up all the
+# time, so it's worth having a reusable (and faster) version of it. A few things help:
+#  - get_domain lowercases the whole address and splits it into a list, only to
+#    throw away everything but the last piece. It's cheaper to find the last "@"
+#    and lowercase only what comes after it.
+#  - A big file will have the same few domains over and over. Interning the keys
+#    means each distinct one is stored once, and lets dict lookups on it succeed
+#    by comparing identity instead of characters.
+#  - If there are too many distinct keys to hold in memory, we can count them
+#    approximately with a fixed number of counters, using the SpaceSaving sketch
+#    from the statistics chapter: every count is too high by at most the
+#    number of lines divided by the number of counters, and it reports how much
+#    too high each count could be.
+#  - Different files can be counted in different processes and the results merged.
+#
+# That last one makes it a script of its own, like line_count_fast.py, with the work
+# under if __name__ == "__main__". On Windows each worker process starts by
+# importing the script, and it mustn't find anything there to run except the
+# function definitions (least of all another pool).
+
+# count_domains.py
+import sys, multiprocessing
+from collections import Counter
+
+try:
+    intern = sys.intern     # where it lives in Python 3
+except AttributeError:
+    pass                    # in Python 2 it's a builtin
+
+def get_domain_fast(email_address):
+    """same as get_domain, but only lowercases the part after the last '@'"""
+    return email_address[email_address.rfind("@") + 1:].lower()
+
+def email_domain(line):
+    """the domain of the address on this line, or None if there isn't one"""
+    if "@" not in line:
+        return None
+    return get_domain_fast(line.strip())
+
+def count_keys(lines, get_key, capacity=None):
+    """count get_key(line) for each line (skipping lines where it's None), exactly
+    in a Counter, or approximately in a SpaceSaving sketch with capacity counters"""
+    counts = SpaceSaving(capacity) if capacity else Counter()
+    add = counts.add if capacity else None
+    for line in lines:
+        key = get_key(line)
+        if key is None:
+            continue
+        key = intern(key)
+        if add:
+            add(key)
+        else:
+            counts[key] += 1
+    return counts
+
+def count_keys_in_file(job):
+    path, get_key, capacity = job
+    with open(path, 'r') as f:
+        return count_keys(f, get_key, capacity)
+
+def count_keys_in_files(paths, get_key, capacity=None, num_workers=None):
+    """count_keys over all the lines of all of paths, one file per process.
+    get_key needs to be defined at the top level, so that it can be sent to
+    the worker processes"""
+    pool = multiprocessing.Pool(num_workers or min(len(paths), multiprocessing.cpu_count()))
+    try:
+        results = pool.map(count_keys_in_file,
+                           [(path, get_key, capacity) for path in paths])
+    finally:
+        pool.close()
+        pool.join()
+
+    total = SpaceSaving(capacity) if capacity else Counter()
+    for result in results:
+        if capacity:
+            total.merge(result)
+        else:
+            total.update(result)
+    return total
+
+if __name__ == "__main__":
+    # pass in the files of email addresses to count
+    domain_counts = count_keys_in_files(sys.argv[1:], email_domain)
+    for domain, count in domain_counts.most_common():
+        print count, domain
+
+# after which you can do something like:
+
+'python count_domains.py email_addresses1.txt email_addresses2.txt'
+
 ## Delimited Files: 
 # The hypothetical email addresses file we just processed had one address per line.
 # More frequently you'll work with files with lots of data on each line. These files
@@ -180,6 +551,151 @@ with open('colon_delimited_stock_prices.txt', 'rb') as f:
 
 # Even if your file doesn't have headers you can still use DictReader by passing it
 # the keys as a fieldnames parameter.
+#
+# csv.DictReader is convenient, but it's not fast: it builds a brand-new dict for
+# every row, and then we call float on each price one row at a time. When a file
+# has millions of rows and we know what's in each column, we can do much better by
+# loading it straight into one typed column per field: an array of doubles for
+# float columns, of integers for int columns (and for date columns, which we
+# store as day numbers via date.toordinal), and a list of interned strings for str
+# columns. We let csv.reader handle the parsing, but convert a whole chunk of rows
+# at a time: zip(*rows) turns the rows into columns, and then each column gets
+# converted with a single map call. Dates get parsed only once per distinct value,
+# since stock prices (say) repeat the same dates over and over.
+#
+# With num_workers, different parts of the file get parsed in different processes
+# (using line_aligned_ranges and read_range from most_common_words_parallel.py),
+# which only works if no field has a newline inside it.
+
+import csv, sys, multiprocessing
+from array import array
+from datetime import date, datetime
+from itertools import islice
+
+try:
+    intern = sys.intern     # where it lives in Python 3
+except AttributeError:
+    pass                    # in Python 2 it's a builtin
+
+def empty_column(column_type):
+    if column_type is float: return array('d')
+    if column_type is int or column_type is date: return array('l')
+    return []
+
+def convert_column(values, column_type, date_format):
+    """converts a sequence of strings into a column of the given type"""
+    if column_type is float:
+        return array('d', map(float, values))
+    if column_type is int:
+        return array('l', map(int, values))
+    if column_type is date:
+        day_numbers = { value : datetime.strptime(value, date_format).toordinal()
+                        for value in set(values) }
+        return array('l', map(day_numbers.__getitem__, values))
+    return list(map(intern, values))
+
+def load_rows(rows, positions, schema, date_format, chunk_size):
+    """turn an iterator of parsed rows into {name: column}"""
+    columns = { name : empty_column(column_type) for name, column_type in schema }
+    needed = max(positions) + 1
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return columns
+        chunk = [row for row in chunk if row]    # skip blank lines, like DictReader
+        if not chunk:
+            continue
+        # zip(*chunk) would silently cut every column down to the shortest row
+        short_rows = [row for row in chunk if len(row) < needed]
+        if short_rows:
+            raise ValueError("row has %d fields but the schema needs %d: %r"
+                             % (len(short_rows[0]), needed, short_rows[0]))
+        values_by_position = list(zip(*chunk))
+        for (name, column_type), position in zip(schema, positions):
+            columns[name].extend(convert_column(values_by_position[position],
+                                                column_type, date_format))
+
+def load_range(job):
+    path, start, stop, delimiter, positions, schema, date_format, chunk_size = job
+    lines = (line for block in read_range(path, start, stop)
+                  for line in block.splitlines(True))
+    return load_rows(csv.reader(lines, delimiter=delimiter), positions, schema,
+                     date_format, chunk_size)
+
+def load_columns(filename, schema, delimiter=',', has_header=False,
+                 date_format="%Y-%m-%d", chunk_size=10000, num_workers=None):
+    """schema is a list of (name, type) pairs, where type is float, int, str or date.
+    if the file has a header, the names pick out columns by their headers;
+    otherwise the schema describes the file's columns in order.
+    returns a dict from each name to its column"""
+    with open(filename, 'rb') as f:
+        if has_header:
+            header = next(csv.reader([f.readline()], delimiter=delimiter))
+            positions = [header.index(name) for name, _ in schema]
+        else:
+            positions = list(range(len(schema)))
+        data_start = f.tell()    # where the header (if any) ends
+
+        if not num_workers:
+            return load_rows(csv.reader(f, delimiter=delimiter), positions,
+                             schema, date_format, chunk_size)
+
+    jobs = [(filename, start, stop, delimiter, positions, schema, date_format,
+             chunk_size)
+            for start, stop in line_aligned_ranges(filename, 4 * num_workers)
+            if stop > data_start]
+    if not jobs:    # nothing after the header
+        return { name : empty_column(column_type) for name, column_type in schema }
+    jobs[0] = (filename, max(jobs[0][1], data_start)) + jobs[0][2:]
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        results = pool.map(load_range, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    columns = { name : empty_column(column_type) for name, column_type in schema }
+    for result in results:
+        for name, _ in schema:
+            columns[name].extend(result[name])
+    return columns
+
+# For example, the colon-delimited stock prices from before:
+
+stock_prices = load_columns('colon_delimited_stock_prices.txt',
+                            [("date", date), ("symbol", str), ("closing_price", float)],
+                            delimiter=':', has_header=True, date_format="%m/%d/%Y")
+
+max(stock_prices["closing_price"])
+date.fromordinal(stock_prices["date"][0])
+
+# To compare it with DictReader, let's generate a million-row file, and time
+# reading the prices both ways (and see how much memory the results take up):
+
+import random, time
+
+with open('big_stock_prices.txt', 'wb') as f:
+    f.write("date:symbol:closing_price\n")
+    for i in range(1000000):
+        f.write("%d/%d/2014:%s:%.2f\n" % (i % 12 + 1, i % 28 + 1,
+                                          random.choice(["AAPL", "MSFT", "FB"]),
+                                          random.uniform(10, 100)))
+
+start = time.time()
+with open('big_stock_prices.txt', 'rb') as f:
+    rows = [(row["date"], row["symbol"], float(row["closing_price"]))
+            for row in csv.DictReader(f, delimiter=':')]
+print "DictReader:", time.time() - start, "seconds"
+print sum(sys.getsizeof(row) + sys.getsizeof(row[2]) for row in rows), "bytes"
+
+start = time.time()
+columns = load_columns('big_stock_prices.txt',
+                       [("date", date), ("symbol", str), ("closing_price", float)],
+                       delimiter=':', has_header=True, date_format="%m/%d/%Y")
+print "load_columns:", time.time() - start, "seconds"
+print sum(sys.getsizeof(column) for column in columns.values()), "bytes"
+
 #
 # You can similarly write out delimited data using csv.writer:
 
@@ -103,6 +103,54 @@ def estimate_gradient(f, v, h=0.00001):
 # it's computationally expensive. If v has length n, estimate_gradient has to evaluate
 # f on 2n different inputs. If you're repeatedly estimating gradients, you're doing a
 # whole lot of extra work.
+#
+# We can at least cut down on the waste. estimate_gradient recomputes f(v) for every
+# coordinate, so evaluating it just once saves n - 1 calls. And each of the perturbed
+# evaluations is independent of the others, so if f is expensive we can farm them
+# out to a pool of workers. Anything with a map method will do: a
+# multiprocessing.Pool (f has to be picklable) or a multiprocessing.pool.ThreadPool
+# (f should release the GIL, e.g. by calling out to NumPy or another program).
+#
+# Central differences, (f(v + h) - f(v - h)) / 2h, cost twice as many evaluations
+# but have error proportional to h**2 rather than h, so they're worth it when you
+# need accurate gradients.
+
+def perturbed_points(v, h):
+    """generator that returns v with h added to each coordinate in turn"""
+    for i in range(len(v)):
+        w = list(v)
+        w[i] += h
+        yield w
+
+def estimate_gradient_fast(f, v, h=0.00001, central=False, pool=None,
+                           batched=False):
+    """estimates the gradient of f at v, evaluating f(v) only once.
+    if pool is given, the perturbed points are evaluated with pool.map.
+    if batched is True, f is called once with the list of all perturbed points
+    (as a 2-D array if v is one) and should return one value per point"""
+
+    if batched:
+        if np is not None and isinstance(v, np.ndarray):
+            evaluate = lambda sign: f(v + sign * h * np.eye(len(v)))
+            f_of = lambda v: f(v[np.newaxis, :])[0]
+        else:
+            evaluate = lambda sign: f(list(perturbed_points(v, sign * h)))
+            f_of = lambda v: f([v])[0]
+    else:
+        f_of = f
+        map_fn = pool.map if pool is not None else map
+        evaluate = lambda sign: list(map_fn(f, perturbed_points(v, sign * h)))
+
+    forward_values = evaluate(1)
+
+    if central:
+        backward_values = evaluate(-1)
+        return [(forward - backward) / (2 * h)
+                for forward, backward in zip(forward_values, backward_values)]
+    else:
+        f_v = f_of(v)
+        return [(forward - f_v) / h for forward in forward_values]
+
 #
 # Using the gradient: It's easy to see that the sum_of_squares function is smallest
 # when its input v is a vector of zeroes. But imagine we didn't know that. Let's use
@@ -171,28 +219,48 @@ def safe(f):
 # Furthermore, let's say we have (somehow) chosen a starting value for the parameters
 # theta_0. Then we can implement gradient descent as:
 
-def minimize_batch(target_fn, gradient_fn, theta_0, tolerance=0.00001):
-    """use gradient descent to find theta that minimizes target function"""
+def minimize_batch(target_fn, gradient_fn, theta_0, tolerance=0.00001,
+                   choose_step=None, callback=None):
+    """use gradient descent to find theta that minimizes target function.
+    choose_step picks how far to move each iteration (see below); by default
+    we try every one of step_sizes. if callback is given, it gets called with
+    a dict describing each iteration (see the section on tracing)"""
 
     step_sizes = [100, 10, 1, 0.1, 0.01, 0.001, 0.0001, 0.00001]
+    if choose_step is None:
+        choose_step = try_all_step_sizes(step_sizes)
 
     theta = theta_0               # set theta to initial value
-    target_fn = safe(target_fn)   # safe version of target_fn
+    if callback is None:
+        target_fn = safe(target_fn)   # safe version of target_fn
+    else:
+        target_fn = instrumented_safe(target_fn)   # that also keeps statistics
+        iteration, last_time = 0, time.time()
     value = target_fn(theta)      # value we're minimizing
 
     while True:
         gradient = gradient_fn(theta)
-        next_thetas = [step(theta, gradient, -step_size)
-                        for step_size in step_sizes]
-    # choose the one that minimizes the error function
-    next_theta = min(next_thetas, key=target_fn)
-    next_value = target_fn(next_theta)
-
-    # stop if we're "converging"
-    if abs(value - next_value) < tolerance:
-        return theta
-    else:
-        theta, value = next_theta, next_value
+        # choose the step that minimizes the error function
+        step_size, next_theta, next_value = choose_step(target_fn, theta,
+                                                        gradient, value)
+
+        if callback is not None:
+            now = time.time()
+            callback({ "iteration" : iteration,
+                       "seconds" : now - last_time,
+                       "value" : next_value,
+                       "gradient_norm" : math.sqrt(dot(gradient, gradient)),
+                       "step_size" : step_size,
+                       "evaluations" : target_fn.calls,
+                       "errors" : target_fn.errors,
+                       "error_seconds" : target_fn.error_seconds })
+            iteration, last_time = iteration + 1, now
+
+        # stop if we're "converging"
+        if abs(value - next_value) < tolerance:
+            return theta
+        else:
+            theta, value = next_theta, next_value
 
 # We called it minimize_batch because, for each gradient step, it looks at the entire
 # data set (because target_fn returns the error on the whole data set). In the next
@@ -209,11 +277,176 @@ def negate_all(f):
     """the same when f returns a list of numbers"""
     return lambda *args, **kwargs: [-y for y in f(*args, **kwargs)]
 
-def maximize_batch(target_fn, gradient_fn, theta_0, tolerance=0.000001):
+def maximize_batch(target_fn, gradient_fn, theta_0, tolerance=0.000001,
+                   choose_step=None, callback=None):
     return minimize_batch(negate(target_fn),
                             negate_all(gradient_fn),
                             theta_0,
-                            tolerance)
+                            tolerance,
+                            choose_step,
+                            callback)
+
+## Choosing Step Sizes More Cleverly:
+# Trying all eight step sizes costs eight evaluations of target_fn per iteration,
+# even when the step size that won last time would have done just fine. So
+# minimize_batch takes the step-choosing logic as a parameter: choose_step is a
+# function choose_step(target_fn, theta, gradient, value) that returns a tuple
+# (step_size, next_theta, next_value), where value is target_fn(theta) (which the
+# caller already knows, so there's no need to compute it again).
+#
+# The default just tries everything. Notice that it remembers the value of each
+# candidate, so that (unlike the first version) the winner isn't evaluated twice:
+
+def try_all_step_sizes(step_sizes):
+    """choose_step that tries every one of step_sizes"""
+    def choose_step(target_fn, theta, gradient, value):
+        candidates = [(target_fn(next_theta), step_size, next_theta)
+                      for step_size in step_sizes
+                      for next_theta in [step(theta, gradient, -step_size)]]
+        next_value, step_size, next_theta = min(candidates,
+                                                key=lambda candidate: candidate[0])
+        return step_size, next_theta, next_value
+    return choose_step
+
+# A popular alternative is backtracking line search: start with a big step, and
+# keep shrinking it until the value decreases by at least a small fraction c of
+# what the gradient predicts (this is called the Armijo condition). Usually the
+# first or second step we try is good enough.
+#
+# Better still, the step size that worked on the last iteration is usually a good
+# guess for this one, so with reuse_last=True we start the search at twice the
+# last successful step size rather than at initial_step_size.
+
+def backtracking_line_search(initial_step_size=1.0, shrink=0.5, c=0.0001,
+                             min_step_size=1e-10, reuse_last=True):
+    """choose_step that shrinks the step size until the Armijo condition holds"""
+    last_step_size = [initial_step_size]   # a list so that choose_step can change it
+
+    def choose_step(target_fn, theta, gradient, value):
+        step_size = 2 * last_step_size[0] if reuse_last else initial_step_size
+        expected_decrease = c * dot(gradient, gradient)
+
+        while step_size >= min_step_size:
+            next_theta = step(theta, gradient, -step_size)
+            next_value = target_fn(next_theta)
+            if next_value <= value - step_size * expected_decrease:
+                last_step_size[0] = step_size
+                return step_size, next_theta, next_value
+            step_size *= shrink
+
+        # no step size helps, so stay put (which makes minimize_batch stop)
+        return 0, theta, value
+    return choose_step
+
+# To see how much work this saves, we can count how many times each approach calls
+# target_fn on the same problem:
+
+def counted(f):
+    """return a function that's the same as f, but that counts how often
+    it gets called (in its calls attribute)"""
+    def counted_f(*args, **kwargs):
+        counted_f.calls += 1
+        return f(*args, **kwargs)
+    counted_f.calls = 0
+    return counted_f
+
+random.seed(0)
+v_0 = [random.randint(-10, 10) for i in range(10)]
+
+for name, choose_step in [("try all", try_all_step_sizes(step_sizes)),
+                          ("backtracking", backtracking_line_search(reuse_last=False)),
+                          ("backtracking + reuse", backtracking_line_search())]:
+    target_fn = counted(sum_of_squares)
+    minimize_batch(target_fn, sum_of_squares_gradient, v_0, choose_step=choose_step)
+    print name, target_fn.calls, "evaluations"
+
+## Vectorizing the Batch Version:
+# Every iteration of minimize_batch builds eight candidate thetas out of Python lists
+# and then runs target_fn on each one separately. That's fine for three parameters,
+# but with thousands of parameters the list arithmetic ends up dominating. If NumPy
+# is available, we can instead stack all the candidates into a single 2-D array
+# (one row per step size) and, if target_fn knows how to handle a whole matrix of
+# thetas at once, evaluate them all in one call:
+
+try:
+    import numpy as np
+except ImportError:
+    np = None   # the list-based versions above still work without it
+
+def safe_batch(f):
+    """like safe, but for a function that takes a 2-D array of thetas (one per row)
+    and returns an array of values: errors and NaNs both turn into infinity"""
+    def safe_f(thetas):
+        try:
+            values = np.asarray(f(thetas), dtype=float)
+        except:
+            return np.full(len(thetas), float('inf'))
+        return np.where(np.isnan(values), float('inf'), values)
+    return safe_f
+
+def minimize_batch_np(target_fn, gradient_fn, theta_0, tolerance=0.00001,
+                      batch_target_fn=None):
+    """same as minimize_batch, but theta, the gradient and all of the candidate
+    thetas live in NumPy arrays. if batch_target_fn is given it's called with the
+    whole (num_step_sizes x num_params) array of candidates and should return one
+    value per row; otherwise target_fn is applied to each row in turn.
+    returns theta as a NumPy array"""
+
+    step_sizes = np.array([100, 10, 1, 0.1, 0.01, 0.001, 0.0001, 0.00001])
+
+    if batch_target_fn is None:
+        target_fn = safe(target_fn)
+        batch_target_fn = lambda thetas: [target_fn(theta) for theta in thetas]
+    batch_target_fn = safe_batch(batch_target_fn)
+
+    theta = np.asarray(theta_0, dtype=float)
+    value = batch_target_fn(theta[np.newaxis, :])[0]
+
+    while True:
+        gradient = np.asarray(gradient_fn(theta), dtype=float)
+        # row k is theta - step_sizes[k] * gradient
+        next_thetas = theta - np.outer(step_sizes, gradient)
+        values = batch_target_fn(next_thetas)
+
+        # choose the one that minimizes the error function, and reuse its value
+        # rather than calling target_fn on it a second time
+        best = np.argmin(values)
+        next_theta, next_value = next_thetas[best], values[best]
+
+        if abs(value - next_value) < tolerance:
+            return theta
+        else:
+            theta, value = next_theta, next_value
+
+def sum_of_squares_np(thetas):
+    """batched sum_of_squares: one value per row of thetas"""
+    return (thetas ** 2).sum(axis=1)
+
+def sum_of_squares_gradient_np(theta):
+    return 2 * theta
+
+# To see how much this buys us, we can time both versions on the same problem. (The
+# list version is slow enough that we stick to a thousand parameters here; the gap
+# only grows as the number of parameters does.)
+
+import time
+
+def time_it(f, *args, **kwargs):
+    """returns (result, seconds) for a single call of f"""
+    start = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - start
+
+random.seed(0)
+theta_0 = [random.uniform(-10, 10) for _ in range(1000)]
+
+_, list_seconds = time_it(minimize_batch, sum_of_squares,
+                          sum_of_squares_gradient, theta_0)
+_, array_seconds = time_it(minimize_batch_np, None,
+                           sum_of_squares_gradient_np, theta_0,
+                           batch_target_fn=sum_of_squares_np)
+
+print "lists:", list_seconds, "arrays:", array_seconds, "speedup:", list_seconds / array_seconds
 
 ## Stochastic Gradient Descent:
 # As we mentioned before, often we'll be using gradient descent to choose the parameter
@@ -238,44 +471,880 @@ def in_random_order(data):
     for i in indexes:
         yield data[i]
 
+# That list of indexes costs a Python int (and a list slot) per data point, every
+# epoch, which adds up when there are hundreds of millions of them. We can avoid it
+# entirely with a little cryptography: a Feistel network scrambles numbers in a way
+# that's guaranteed to be one-to-one, so running 0, 1, 2, ... through it visits
+# every index exactly once, in a random-looking order, using constant memory.
+#
+# The network splits each number's bits into two halves, which can differ in size
+# by a bit, so we run it over the smallest power of two that covers len(data) and
+# skip the outputs that are too big (which is fewer than half of them).
+
+def feistel_round(half, key):
+    """mixes the bits of half and key (any deterministic scrambling will do)"""
+    half = ((half ^ key) * 0x45d9f3b) & 0xffffffff
+    return half ^ (half >> 16)
+
+def random_permutation(n, seed=None, rounds=4):
+    """generator that returns each of 0, ..., n - 1 exactly once in a random order.
+    the same seed always gives the same order; with no seed, the keys come
+    from the random module (so random.seed makes it reproducible as well)"""
+    rng = random.Random(seed) if seed is not None else random
+    keys = [rng.getrandbits(32) for _ in range(rounds)]
+
+    total_bits = max(1, (n - 1).bit_length())
+    left_bits = total_bits // 2
+    right_bits = total_bits - left_bits
+    # each round swaps the halves, so the new right half alternates between
+    # left_bits and right_bits wide
+    keys_and_masks = [(key, (1 << (left_bits if r % 2 == 0 else right_bits)) - 1)
+                      for r, key in enumerate(keys)]
+    final_right_bits = right_bits if rounds % 2 == 0 else left_bits
+
+    right_mask = (1 << right_bits) - 1
+    i, limit = 0, 1 << total_bits
+    while i < limit:    # (range would build a list of all of them in Python 2)
+        left, right = i >> right_bits, i & right_mask
+        for key, mask in keys_and_masks:
+            left, right = right, left ^ (feistel_round(right, key) & mask)
+        j = (left << final_right_bits) | right
+        if j < n:
+            yield j
+        i += 1
+
+def in_random_order_compact(data, seed=None):
+    """like in_random_order, but without building a list of indexes"""
+    for i in random_permutation(len(data), seed):
+        yield data[i]
+
+# Constant memory isn't free, though: every index goes through a few rounds of
+# Python arithmetic, and up to half of them get thrown away, so an epoch can take
+# up to three times as long as with in_random_order. If it's rebuilding the list
+# every epoch (rather than memory as such) that hurts, a middle ground is to make
+# one compact array of indexes (8 bytes apiece, instead of a list slot plus a
+# Python int) and shuffle it in place at the start of each epoch:
+
+from array import array
+
+def in_random_order_reusing(data, indexes):
+    """like in_random_order, but shuffles indexes (an array('l') of 0, ...,
+    len(data) - 1, made once and reused every epoch) instead of a new list"""
+    random.shuffle(indexes)
+    for i in indexes:
+        yield data[i]
+
+# which you'd use like:
+#   indexes = array('l', range(len(data)))
+#   for epoch in range(num_epochs):
+#       for x_i, y_i in in_random_order_reusing(data, indexes): ...
+
 # And we'll want to take a gradient step for each data point. This approach leaves
 # the possibility that we might circle around near a minimum forever, so whenever
-# we stop getting improvements we'll decrease the step size and eventually quit:
+# we stop getting improvements we'll decrease the step size and eventually quit.
+#
+# Taking a step per data point also means a Python-level gradient_fn call (and a
+# vector_subtract) per data point, which gets slow on big data sets. A common middle
+# ground is mini-batch gradient descent, where each step uses a small random slice
+# of the data. When batch_size is given, target_fn and gradient_fn get called with
+# a list (or array) of x's and the matching y's instead of a single pair:
+#  - target_fn(x_batch, y_batch, theta) returns the total error over the batch
+#  - gradient_fn(x_batch, y_batch, theta) returns the average gradient over the batch
+# (averaging means alpha_0 doesn't need to change as batch_size does.)
 
-def minimize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01):
+def in_random_batches(x, y, batch_size):
+    """generator that returns (x_batch, y_batch) slices of x and y in random order"""
+    if np is not None and isinstance(x, np.ndarray):
+        # an array of indexes rather than a list of Python ints, seeded from the
+        # random module so that random.seed still makes it reproducible
+        indexes = np.random.RandomState(random.getrandbits(32)).permutation(len(x))
+        for start in range(0, len(indexes), batch_size):
+            batch = indexes[start:start + batch_size]
+            yield x[batch], y[batch]
+        return
 
-    data = zip(x, y)
-    theta = theta_0   #initial guess
+    indexes = [i for i, _ in enumerate(x)]
+    random.shuffle(indexes)
+    for start in range(0, len(indexes), batch_size):
+        batch = indexes[start:start + batch_size]
+        yield [x[i] for i in batch], [y[i] for i in batch]
+
+def in_batches(x, y, batch_size):
+    """generator that returns (x_batch, y_batch) slices of x and y in order"""
+    for start in range(0, len(x), batch_size):
+        yield x[start:start + batch_size], y[start:start + batch_size]
+
+def minimize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01,
+                        batch_size=None, callback=None,
+                        checkpoint_path=None, checkpoint_every=10, resume=False):
+    """if checkpoint_path is given, the optimizer's state is saved there every
+    checkpoint_every epochs; with resume=True we pick up from that file instead
+    of starting at theta_0 (see resume_stochastic below)"""
+
+    data = zip(x, y) if batch_size is None else None   # only needed one at a time
+    if resume:
+        (alpha_0, theta, alpha, min_theta, min_value, value,
+         iterations_with_no_improvement, epoch) = load_checkpoint(checkpoint_path)
+    else:
+        theta = theta_0   #initial guess
+        alpha = alpha_0   # initial step size
+        min_theta, min_value = None, float("inf")  # the minimum so far
+        iterations_with_no_improvement = 0
+        epoch = 0
+    evaluate = not resume   # a checkpoint already includes this epoch's value
+
+    tracing = callback is not None
+    if tracing:
+        last_time = time.time()
+        # the wrapper keeps the statistics, so that the loops below are exactly
+        # the same whether or not we're tracing
+        gradient_fn = recorded_gradients(gradient_fn)
+
+    # if we ever go 100 iterations with no improvement, stop
+    while iterations_with_no_improvement < 100:
+        if evaluate:
+            if batch_size is None:
+                value = sum( target_fn(x_i, y_i, theta) for x_i, y_i in data )
+            else:
+                value = sum( target_fn(x_batch, y_batch, theta)
+                             for x_batch, y_batch in in_batches(x, y, batch_size) )
+
+            if value < min_value:
+                # if we've found a new minimum, remember it
+                # and go back to the original step size
+                min_theta, min_value = theta, value
+                iterations_with_no_improvement = 0
+                alpha = alpha_0
+            else:
+                # otherwise we're not improving, so try shrinking the step size
+                iterations_with_no_improvement += 1
+                alpha *= 0.9
+
+            if checkpoint_path is not None and epoch % checkpoint_every == 0:
+                save_checkpoint(checkpoint_path, alpha_0, theta, alpha, min_theta,
+                                min_value, value, iterations_with_no_improvement,
+                                epoch)
+        evaluate = True
+
+        if batch_size is None:
+            # and take a gradient step for each of the data points
+            for x_i, y_i in in_random_order(data):
+                gradient_i = gradient_fn(x_i, y_i, theta)
+                theta = vector_subtract(theta, scalar_multiply(alpha, gradient_i))
+        else:
+            # or for each mini-batch
+            for x_batch, y_batch in in_random_batches(x, y, batch_size):
+                gradient_batch = gradient_fn(x_batch, y_batch, theta)
+                theta = vector_subtract(theta, scalar_multiply(alpha, gradient_batch))
+
+        if tracing:
+            now = time.time()
+            num_steps = gradient_fn.calls
+            callback({ "iteration" : epoch,
+                       "seconds" : now - last_time,
+                       "value" : value,
+                       "gradient_norm" : math.sqrt(gradient_fn.sum_squared_norms /
+                                                   max(num_steps, 1)),
+                       "step_size" : alpha,
+                       "evaluations" : num_steps,
+                       "errors" : 0,
+                       "error_seconds" : 0.0 })
+            gradient_fn.calls, gradient_fn.sum_squared_norms = 0, 0.0
+            last_time = now
+        epoch += 1
+
+    return min_theta
+
+# The stochastic version will typically be a lot faster than the batch version. Of course,
+# we'll want a version that maximizes as well:
+
+def maximize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01,
+                        batch_size=None, callback=None,
+                        checkpoint_path=None, checkpoint_every=10, resume=False):
+    return minimize_stochastic(negate(target_fn),
+                                negate_all(gradient_fn),
+                                x, y, theta_0, alpha_0, batch_size, callback,
+                                checkpoint_path, checkpoint_every, resume)
+
+# To get a feel for how batch_size trades off, let's time a single epoch (one pass
+# of gradient steps over the data) on a million-row synthetic regression problem
+# y = 3 + 2x + noise, fitting theta = [alpha, beta]:
+
+def squared_error(x_i, y_i, theta):
+    alpha, beta = theta
+    return (y_i - (alpha + beta * x_i)) ** 2
+
+def squared_error_gradient(x_i, y_i, theta):
+    alpha, beta = theta
+    error = y_i - (alpha + beta * x_i)
+    return [-2 * error, -2 * error * x_i]
+
+def squared_error_batch(x_batch, y_batch, theta):
+    alpha, beta = theta
+    errors = y_batch - (alpha + beta * x_batch)
+    return (errors ** 2).sum()
+
+def squared_error_gradient_batch(x_batch, y_batch, theta):
+    alpha, beta = theta
+    errors = y_batch - (alpha + beta * x_batch)
+    return [-2 * errors.mean(), -2 * (errors * x_batch).mean()]
+
+np.random.seed(0)
+x_big = np.random.uniform(-1, 1, 1000000)
+y_big = 3 + 2 * x_big + np.random.normal(0, 0.1, 1000000)
+
+def one_epoch(x, y, theta, alpha, batch_size):
+    if batch_size is None:
+        for x_i, y_i in in_random_order(zip(x, y)):
+            theta = vector_subtract(theta, scalar_multiply(alpha,
+                                    squared_error_gradient(x_i, y_i, theta)))
+    else:
+        for x_batch, y_batch in in_random_batches(x, y, batch_size):
+            theta = vector_subtract(theta, scalar_multiply(alpha,
+                                    squared_error_gradient_batch(x_batch, y_batch, theta)))
+    return theta
+
+_, seconds = time_it(one_epoch, x_big.tolist(), y_big.tolist(), [0, 0], 0.01, None)
+print "one point at a time:", seconds, "seconds per epoch"
+
+for batch_size in [10, 100, 1000, 10000]:
+    _, seconds = time_it(one_epoch, x_big, y_big, [0, 0], 0.01, batch_size)
+    print "batch_size", batch_size, ":", seconds, "seconds per epoch"
+
+# Bigger batches mean far fewer Python-level calls per epoch, but also fewer
+# steps per epoch, so past a point you need more epochs to converge.
+
+## Streaming Stochastic Gradient Descent:
+# minimize_stochastic needs all of x and y in memory (and zip makes yet another
+# copy of them). If the data lives in a file that's too big for that, we can
+# stream it instead, as long as we're willing to give up on a perfect shuffle.
+#
+# Instead of x and y, we'll take a function that returns a fresh iterator of
+# (x_i, y_i) pairs each time it's called (since most of the time that means
+# reopening a file). And instead of shuffling the whole data set, we'll shuffle
+# through a fixed-size buffer: fill it up, and then for each new pair, swap it
+# with a randomly chosen pair from the buffer and yield that one. Data more than
+# buffer_size rows apart never get swapped, so it's still a good idea to store the
+# file in no particular order.
+
+def shuffle_buffer(pairs, buffer_size):
+    """generator that returns the elements of pairs in a random order,
+    holding at most buffer_size of them in memory at a time"""
+    buffer = []
+    for pair in pairs:
+        if len(buffer) < buffer_size:
+            buffer.append(pair)
+        else:
+            i = random.randrange(buffer_size)
+            yield buffer[i]
+            buffer[i] = pair
+
+    random.shuffle(buffer)
+    for pair in buffer:
+        yield pair
+
+def minimize_stochastic_streaming(target_fn, gradient_fn, make_pairs, theta_0,
+                                  alpha_0=0.01, buffer_size=10000):
+    """same as minimize_stochastic, but make_pairs() returns an iterator
+    of (x_i, y_i) pairs, and only buffer_size of them are kept in memory"""
+
+    theta = theta_0   # initial guess
     alpha = alpha_0   # initial step size
     min_theta, min_value = None, float("inf")  # the minimum so far
     iterations_with_no_improvement = 0
 
     # if we ever go 100 iterations with no improvement, stop
     while iterations_with_no_improvement < 100:
-        value = sum( target_fn(x_i, y_i, theta) for x_i, y_i in data )
+        value = sum( target_fn(x_i, y_i, theta) for x_i, y_i in make_pairs() )
 
         if value < min_value:
-            # if we've found a new minimum, remember it
-            # and go back to the original step size
             min_theta, min_value = theta, value
             iterations_with_no_improvement = 0
             alpha = alpha_0
         else:
-            # otherwise we're not improving, so try shrinking the step size
             iterations_with_no_improvement += 1
             alpha *= 0.9
 
-        # and take a gradient step for each of the data points
+        for x_i, y_i in shuffle_buffer(make_pairs(), buffer_size):
+            gradient_i = gradient_fn(x_i, y_i, theta)
+            theta = vector_subtract(theta, scalar_multiply(alpha, gradient_i))
+
+    return min_theta
+
+# A source for delimited files can use the csv module (which we'll see more of when
+# we get to getting data), reading the features from x_columns and the target from
+# y_column:
+
+import csv
+
+def csv_pairs(filename, x_columns, y_column, delimiter=',', has_header=False):
+    """returns a make_pairs function that streams ([x_i...], y_i) from a file"""
+    def make_pairs():
+        with open(filename, 'rb') as f:
+            reader = csv.reader(f, delimiter=delimiter)
+            if has_header:
+                next(reader)
+            for row in reader:
+                yield ([float(row[j]) for j in x_columns], float(row[y_column]))
+    return make_pairs
+
+# And if the data is stored as raw binary doubles, num_features x values followed by
+# the y value for each row, we can memory-map the file and let the operating system
+# worry about which pages are in memory:
+
+import mmap, struct
+
+def binary_pairs(filename, num_features):
+    """returns a make_pairs function that streams ([x_i...], y_i) from a file of
+    doubles laid out row by row as x_i1, ..., x_in, y_i"""
+    row = struct.Struct('%dd' % (num_features + 1))
+    def make_pairs():
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # (a while loop, since range would make a list of every offset
+                # in Python 2)
+                offset = 0
+                while offset + row.size <= len(mapped):
+                    values = row.unpack_from(mapped, offset)
+                    yield list(values[:-1]), values[-1]
+                    offset += row.size
+            finally:
+                mapped.close()
+    return make_pairs
+
+
+## Adaptive Update Rules:
+# minimize_stochastic's only trick is to shrink alpha by 10% whenever an epoch doesn't
+# help, which means it needs a hundred unhelpful epochs before it gives up. Most
+# modern optimizers instead adapt the step for each parameter as they go:
+#  - momentum keeps a running "velocity" so that consistent gradients speed up,
+#    and Nesterov momentum corrects the velocity by looking ahead
+#  - AdaGrad divides each parameter's step by the root of its summed squared gradients
+#  - RMSProp does the same with an exponentially decaying average instead of a sum
+#  - Adam combines momentum with RMSProp (and corrects both for starting at zero)
+#
+# Each of these is an update rule: a function update(theta, gradient) that returns
+# the next theta. Since they need to remember things between steps, we'll create
+# them with functions that keep their per-parameter state in compact arrays of
+# doubles (created the first time we see theta, so we don't need to know its size):
+
+from array import array
+
+def zeros_like(theta):
+    return array('d', [0.0]) * len(theta)
+
+def plain_update(alpha=0.01):
+    """update rule for ordinary gradient descent with a fixed step size"""
+    def update(theta, gradient):
+        return [theta_i - alpha * g_i for theta_i, g_i in zip(theta, gradient)]
+    return update
+
+def momentum_update(alpha=0.01, beta=0.9, nesterov=False):
+    """update rule for (optionally Nesterov) momentum"""
+    state = []
+
+    def update(theta, gradient):
+        if not state: state.append(zeros_like(theta))
+        velocity = state[0]
+        next_theta = []
+        for i, (theta_i, g_i) in enumerate(zip(theta, gradient)):
+            v_i = beta * velocity[i] - alpha * g_i
+            if nesterov:
+                # equivalent to evaluating the gradient at the look-ahead point
+                next_theta.append(theta_i - beta * velocity[i] + (1 + beta) * v_i)
+            else:
+                next_theta.append(theta_i + v_i)
+            velocity[i] = v_i
+        return next_theta
+    return update
+
+def adagrad_update(alpha=0.1, epsilon=1e-8):
+    """update rule for AdaGrad"""
+    state = []
+
+    def update(theta, gradient):
+        if not state: state.append(zeros_like(theta))
+        sum_squares = state[0]
+        next_theta = []
+        for i, (theta_i, g_i) in enumerate(zip(theta, gradient)):
+            sum_squares[i] += g_i ** 2
+            next_theta.append(theta_i - alpha * g_i / (math.sqrt(sum_squares[i]) + epsilon))
+        return next_theta
+    return update
+
+def rmsprop_update(alpha=0.01, decay=0.9, epsilon=1e-8):
+    """update rule for RMSProp"""
+    state = []
+
+    def update(theta, gradient):
+        if not state: state.append(zeros_like(theta))
+        mean_squares = state[0]
+        next_theta = []
+        for i, (theta_i, g_i) in enumerate(zip(theta, gradient)):
+            mean_squares[i] = decay * mean_squares[i] + (1 - decay) * g_i ** 2
+            next_theta.append(theta_i - alpha * g_i / (math.sqrt(mean_squares[i]) + epsilon))
+        return next_theta
+    return update
+
+def adam_update(alpha=0.01, beta1=0.9, beta2=0.999, epsilon=1e-8):
+    """update rule for Adam"""
+    state = []
+
+    def update(theta, gradient):
+        if not state: state.extend([zeros_like(theta), zeros_like(theta), [0]])
+        means, mean_squares, steps = state
+        steps[0] += 1
+        correction1 = 1 - beta1 ** steps[0]   # corrects for means starting at 0
+        correction2 = 1 - beta2 ** steps[0]
+        next_theta = []
+        for i, (theta_i, g_i) in enumerate(zip(theta, gradient)):
+            means[i] = beta1 * means[i] + (1 - beta1) * g_i
+            mean_squares[i] = beta2 * mean_squares[i] + (1 - beta2) * g_i ** 2
+            m_hat, v_hat = means[i] / correction1, mean_squares[i] / correction2
+            next_theta.append(theta_i - alpha * m_hat / (math.sqrt(v_hat) + epsilon))
+        return next_theta
+    return update
+
+# Any of these can then drive either the batch or the stochastic version, with the
+# same target_fn and gradient_fn as before:
+
+def minimize_adaptive(target_fn, gradient_fn, theta_0, update,
+                      tolerance=0.00001, max_iterations=10000):
+    """batch gradient descent, using update to take each step"""
+    theta = theta_0
+    value = target_fn(theta)
+
+    for _ in range(max_iterations):
+        next_theta = update(theta, gradient_fn(theta))
+        next_value = target_fn(next_theta)
+
+        # stop if we're "converging"
+        if abs(value - next_value) < tolerance:
+            return next_theta
+        theta, value = next_theta, next_value
+
+    return theta
+
+def minimize_stochastic_adaptive(target_fn, gradient_fn, x, y, theta_0, update,
+                                 patience=10, max_epochs=1000):
+    """stochastic gradient descent, using update to take each step. since update
+    adapts the step sizes itself, we just stop after patience epochs in a row
+    without improvement"""
+
+    data = zip(x, y)
+    theta = theta_0
+    min_theta, min_value = None, float("inf")
+    epochs_with_no_improvement = 0
+
+    for _ in range(max_epochs):
+        value = sum( target_fn(x_i, y_i, theta) for x_i, y_i in data )
+
+        if value < min_value:
+            min_theta, min_value = theta, value
+            epochs_with_no_improvement = 0
+        else:
+            epochs_with_no_improvement += 1
+            if epochs_with_no_improvement >= patience:
+                break
+
+        for x_i, y_i in in_random_order(data):
+            theta = update(theta, gradient_fn(x_i, y_i, theta))
+
+    return min_theta
+
+# To compare them, let's count gradient evaluations (and time) on a couple of
+# shared problems: our sum_of_squares from a random 10-dimensional start, and the
+# notoriously slow-to-solve Rosenbrock function, whose minimum is at [1, 1]:
+
+def rosenbrock(v):
+    x, y = v
+    return (1 - x) ** 2 + 100 * (y - x ** 2) ** 2
+
+def rosenbrock_gradient(v):
+    x, y = v
+    return [-2 * (1 - x) - 400 * x * (y - x ** 2), 200 * (y - x ** 2)]
+
+update_rules = [("momentum", lambda: momentum_update(alpha=0.001)),
+                ("nesterov", lambda: momentum_update(alpha=0.001, nesterov=True)),
+                ("adagrad", lambda: adagrad_update()),
+                ("rmsprop", lambda: rmsprop_update(alpha=0.001)),
+                ("adam", lambda: adam_update())]
+
+for problem, target_fn, raw_gradient_fn, theta_0 in [
+        ("sum_of_squares", sum_of_squares, sum_of_squares_gradient, v_0),
+        ("rosenbrock", rosenbrock, rosenbrock_gradient, [-1.5, 2.0])]:
+
+    # a fresh counter for each run, so they all pay for exactly one wrapper
+    gradient_fn = counted(raw_gradient_fn)
+    theta, seconds = time_it(minimize_batch, target_fn, gradient_fn, theta_0)
+    print problem, "minimize_batch:", gradient_fn.calls, "gradients", seconds, "seconds"
+
+    for name, make_update in update_rules:
+        gradient_fn = counted(raw_gradient_fn)
+        theta, seconds = time_it(minimize_adaptive, target_fn, gradient_fn, theta_0,
+                                 make_update(), tolerance=1e-10, max_iterations=100000)
+        print problem, name, ":", gradient_fn.calls, "gradients", seconds, "seconds"
+
+# and on the stochastic side, the squared_error regression from before (on a
+# more manageable thousand points):
+
+x_small, y_small = x_big[:1000].tolist(), y_big[:1000].tolist()
+
+theta, seconds = time_it(minimize_stochastic, squared_error, squared_error_gradient,
+                         x_small, y_small, [0, 0])
+print "minimize_stochastic:", theta, seconds, "seconds"
+
+for name, make_update in update_rules:
+    theta, seconds = time_it(minimize_stochastic_adaptive, squared_error,
+                             squared_error_gradient, x_small, y_small, [0, 0],
+                             make_update())
+    print name, ":", theta, seconds, "seconds"
+
+
+## Data-Parallel Stochastic Gradient Descent:
+# All of the above runs on a single core. Since the error is a sum over the data
+# points, one way to use more cores is to split the data into shards, one per
+# worker process. In each epoch every worker starts from the same theta, takes SGD
+# steps over its own shard, and sends back where it ended up. Then we average the
+# workers' thetas to get the theta for the next epoch. (This is "parameter
+# averaging"; it works well for convex problems like regression.)
+#
+# The workers get the data once, when they start, so each epoch only sends theta
+# back and forth. (On systems where multiprocessing forks, which includes Linux,
+# the data isn't even copied until a worker touches it; elsewhere, target_fn and
+# gradient_fn need to be picklable, i.e. defined at the top level of a module.)
+
+import multiprocessing
+
+sgd_worker_state = {}   # filled in separately in each worker process
+
+def init_sgd_worker(target_fn, gradient_fn, x, y):
+    sgd_worker_state.update(target_fn=target_fn, gradient_fn=gradient_fn,
+                            data=zip(x, y))
+
+def shard_value(shard):
+    """the total error on data[start:stop] at theta"""
+    start, stop, theta = shard
+    target_fn = sgd_worker_state["target_fn"]
+    return sum(target_fn(x_i, y_i, theta)
+               for x_i, y_i in sgd_worker_state["data"][start:stop])
+
+def shard_sgd(shard):
+    """takes local_epochs of gradient steps over data[start:stop],
+    starting from theta, and returns the resulting theta"""
+    start, stop, theta, alpha, local_epochs, seed = shard
+    gradient_fn = sgd_worker_state["gradient_fn"]
+    data = sgd_worker_state["data"][start:stop]
+    random.seed(seed)   # so that workers don't all shuffle the same way
+
+    for _ in range(local_epochs):
         for x_i, y_i in in_random_order(data):
             gradient_i = gradient_fn(x_i, y_i, theta)
             theta = vector_subtract(theta, scalar_multiply(alpha, gradient_i))
+    return theta
+
+def minimize_stochastic_parallel(target_fn, gradient_fn, x, y, theta_0,
+                                 alpha_0=0.01, num_workers=None,
+                                 local_epochs=1, max_epochs=None):
+    """same as minimize_stochastic, but with the data split across num_workers
+    processes (one per core by default) whose thetas get averaged every epoch"""
+
+    num_workers = num_workers or multiprocessing.cpu_count()
+    n = len(x)
+    bounds = [(n * k // num_workers, n * (k + 1) // num_workers)
+              for k in range(num_workers)]
+
+    theta = theta_0   # initial guess
+    alpha = alpha_0   # initial step size
+    min_theta, min_value = None, float("inf")  # the minimum so far
+    iterations_with_no_improvement = 0
+    epoch = 0
+
+    pool = multiprocessing.Pool(num_workers, initializer=init_sgd_worker,
+                                initargs=(target_fn, gradient_fn, x, y))
+    try:
+        while iterations_with_no_improvement < 100:
+            if max_epochs is not None and epoch >= max_epochs:
+                break
+
+            value = sum(pool.map(shard_value, [(start, stop, theta)
+                                               for start, stop in bounds]))
+
+            if value < min_value:
+                min_theta, min_value = theta, value
+                iterations_with_no_improvement = 0
+                alpha = alpha_0
+            else:
+                iterations_with_no_improvement += 1
+                alpha *= 0.9
+
+            thetas = pool.map(shard_sgd, [(start, stop, theta, alpha, local_epochs,
+                                           random.getrandbits(32))
+                                          for start, stop in bounds])
+            theta = vector_mean(thetas)
+            epoch += 1
+    finally:
+        pool.close()
+        pool.join()
 
     return min_theta
 
-# The stochastic version will typically be a lot faster than the batch version. Of course,
-# we'll want a version that maximizes as well:
+# To see how it scales, we can time ten epochs on a hundred thousand points with
+# different numbers of workers. Each epoch only ships theta and a handful of
+# numbers between processes, so the speedup should be close to the number of cores
+# (as long as there are that many cores available).
+#
+# Be warned that on Windows each worker process gets init_sgd_worker and shard_sgd
+# by importing this file, which re-runs the whole chapter, million-point x_big
+# and epoch timings included, before the worker does any work. The check for
+# __main__ below only keeps the workers from running this benchmark (and starting
+# pools of their own). For real use, put minimize_stochastic_parallel and the
+# functions it calls in a module with nothing else at the top level.
 
-def maximize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01):
-    return minimize_stochastic(negate(target_fn),
-                                negate_all(gradient_fn),
-                                x, y, theta_0, alpha_0)
\ No newline at end of file
+if __name__ == "__main__":
+    x_medium, y_medium = x_big[:100000].tolist(), y_big[:100000].tolist()
+    seconds_by_workers = {}
+
+    for num_workers in [1, 2, 4, 8]:
+        _, seconds = time_it(minimize_stochastic_parallel, squared_error,
+                             squared_error_gradient, x_medium, y_medium, [0, 0],
+                             num_workers=num_workers, max_epochs=10)
+        seconds_by_workers[num_workers] = seconds
+        print num_workers, "workers:", seconds, "seconds,", seconds_by_workers[1] / seconds, "x"
+
+
+## Tracing the Optimizers:
+# When an optimization is slow, it helps to know why. Are the iterations slow, or
+# are there just too many of them? Is the gradient shrinking? Which step sizes are
+# being chosen? Is target_fn blowing up (and silently getting turned into infinity
+# by safe)? minimize_batch and minimize_stochastic take an optional callback,
+# which (if given) is called after each iteration with a dict of:
+#  - iteration: 0, 1, 2, ...
+#  - seconds: wall-clock time the iteration took
+#  - value: the target value (for minimize_stochastic, at the start of the epoch)
+#  - gradient_norm: the length of the gradient (for minimize_stochastic, the root
+#    mean square length over the epoch's steps)
+#  - step_size: the step size chosen (for minimize_stochastic, alpha)
+#  - evaluations: the number of target_fn calls so far (for minimize_stochastic,
+#    gradient steps in this epoch)
+#  - errors, error_seconds: how many target_fn calls safe turned into infinity so
+#    far, and how long they took (always 0 for minimize_stochastic, which doesn't
+#    use safe)
+#
+# When there's no callback none of this is computed: minimize_batch checks for a
+# callback once per iteration, and minimize_stochastic's inner loops don't check at
+# all, since with a callback it wraps gradient_fn in something that keeps the
+# statistics instead.
+#
+# To count the errors, minimize_batch uses a version of safe that keeps statistics:
+
+import time
+
+def instrumented_safe(f):
+    """like safe(f), but the returned function counts its calls, its errors,
+    and the time spent in calls that errored"""
+    def safe_f(*args, **kwargs):
+        safe_f.calls += 1
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        except:
+            safe_f.errors += 1
+            safe_f.error_seconds += time.time() - start
+            return float('inf')
+    safe_f.calls, safe_f.errors, safe_f.error_seconds = 0, 0, 0.0
+    return safe_f
+
+def recorded_gradients(gradient_fn):
+    """like gradient_fn, but the returned function counts its calls and adds up
+    the squared lengths of the gradients it returns (in sum_squared_norms)"""
+    def recorded_gradient_fn(*args):
+        gradient = gradient_fn(*args)
+        recorded_gradient_fn.calls += 1
+        recorded_gradient_fn.sum_squared_norms += dot(gradient, gradient)
+        return gradient
+    recorded_gradient_fn.calls, recorded_gradient_fn.sum_squared_norms = 0, 0.0
+    return recorded_gradient_fn
+
+# Any function will do as a callback, but usually we'll want to keep the records
+# around. Since a long run can have millions of iterations, ConvergenceTracer only
+# keeps the most recent capacity of them, each field in its own compact array:
+
+import csv, json
+
+class ConvergenceTracer:
+    """a callback that records the last capacity iterations in a ring buffer"""
+
+    fields = ["iteration", "seconds", "value", "gradient_norm", "step_size",
+              "evaluations", "errors", "error_seconds"]
+    integer_fields = ["iteration", "evaluations", "errors"]
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.count = 0      # how many iterations we've seen in total
+        self.columns = { field : (array('l', [0]) if field in self.integer_fields
+                                  else array('d', [0.0])) * capacity
+                         for field in self.fields }
+
+    def __call__(self, info):
+        position = self.count % self.capacity
+        for field in self.fields:
+            self.columns[field][position] = info[field]
+        self.count += 1
+
+    def records(self):
+        """the recorded iterations as dicts, oldest first"""
+        first = max(0, self.count - self.capacity)
+        for i in range(first, self.count):
+            position = i % self.capacity
+            yield { field : self.columns[field][position]
+                    for field in self.fields }
+
+    def to_csv(self, filename):
+        with open(filename, 'wb') as f:
+            writer = csv.DictWriter(f, fieldnames=self.fields)
+            writer.writeheader()
+            for record in self.records():
+                writer.writerow(record)
+
+    def to_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(list(self.records()), f)
+
+# For example, on the Rosenbrock function:
+
+tracer = ConvergenceTracer()
+minimize_batch(rosenbrock, rosenbrock_gradient, [-1.5, 2.0], callback=tracer)
+tracer.to_csv('rosenbrock_trace.csv')
+
+for record in tracer.records():
+    if record["iteration"] % 100 == 0:
+        print record
+
+# To check that leaving out the callback really is free, we can compare against
+# minimize_batch as it was before it took a callback (taking the best of a few
+# runs of each, to smooth out the noise):
+
+def minimize_batch_without_hooks(target_fn, gradient_fn, theta_0, tolerance=0.00001,
+                                 choose_step=None):
+    """minimize_batch from before we added callback"""
+    step_sizes = [100, 10, 1, 0.1, 0.01, 0.001, 0.0001, 0.00001]
+    if choose_step is None:
+        choose_step = try_all_step_sizes(step_sizes)
+
+    theta = theta_0
+    target_fn = safe(target_fn)
+    value = target_fn(theta)
+
+    while True:
+        gradient = gradient_fn(theta)
+        _, next_theta, next_value = choose_step(target_fn, theta, gradient, value)
+        if abs(value - next_value) < tolerance:
+            return theta
+        else:
+            theta, value = next_theta, next_value
+
+def best_time(f, *args, **kwargs):
+    return min(time_it(f, *args, **kwargs)[1] for _ in range(5))
+
+without_hooks_seconds = best_time(minimize_batch_without_hooks, rosenbrock,
+                                  rosenbrock_gradient, [-1.5, 2.0])
+untraced_seconds = best_time(minimize_batch, rosenbrock, rosenbrock_gradient,
+                             [-1.5, 2.0])
+traced_seconds = best_time(minimize_batch, rosenbrock, rosenbrock_gradient,
+                           [-1.5, 2.0], callback=ConvergenceTracer())
+print "without hooks:", without_hooks_seconds, "untraced:", untraced_seconds, "traced:", traced_seconds
+
+
+## Checkpointing:
+# A big minimize_stochastic run can take hours, and everything it knows lives in
+# local variables, so if the machine goes down we have to start over. Passing a
+# checkpoint_path makes it save its state every checkpoint_every epochs, right
+# before it shuffles the data: theta, the best theta and value so far, alpha and
+# its starting value, the no-improvement counter, the epoch number, and the state
+# of the random number generator. Resuming from that file then takes exactly the
+# same steps the original run would have, so we get bit-for-bit the same answer.
+#
+# We store everything as raw doubles and integers (much smaller than, say, JSON),
+# and we write to a temporary file and then rename it over the old checkpoint, so
+# that a crash in the middle of writing can't leave us with a corrupt checkpoint.
+# (Python 3's os.replace does that rename on any platform. On Python 2, os.rename
+# refuses to replace an existing file on Windows, so there we ask Windows directly.)
+
+import os, struct
+
+def replace_file(source, target):
+    """atomically rename source to target, replacing target if it exists"""
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+    elif os.name == 'nt':
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING, MOVEFILE_WRITE_THROUGH = 0x1, 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(
+                unicode(source), unicode(target),
+                MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(source, target)   # which replaces target on Unix
+
+CHECKPOINT_MAGIC = b'SGD1'
+checkpoint_header = struct.Struct('<4sdddd?qqqqq?d')
+
+def save_checkpoint(path, alpha_0, theta, alpha, min_theta, min_value, value,
+                    iterations_with_no_improvement, epoch):
+    rng_version, rng_internal, rng_gauss = random.getstate()
+    has_min_theta = min_theta is not None
+    if not has_min_theta:
+        min_theta = theta   # just to keep the layout fixed
+
+    header = checkpoint_header.pack(CHECKPOINT_MAGIC, alpha_0, alpha, min_value,
+                                    value, has_min_theta,
+                                    iterations_with_no_improvement, epoch,
+                                    len(theta), rng_version, len(rng_internal),
+                                    rng_gauss is not None,
+                                    rng_gauss if rng_gauss is not None else 0.0)
+    body = (struct.pack('<%dd' % len(theta), *theta) +
+            struct.pack('<%dd' % len(min_theta), *min_theta) +
+            struct.pack('<%dI' % len(rng_internal), *rng_internal))
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(header + body)
+        f.flush()
+        os.fsync(f.fileno())   # make sure it's really on disk before renaming
+    replace_file(temp_path, path)
+
+def load_checkpoint(path):
+    """restores the random number generator, and returns (alpha_0, theta, alpha,
+    min_theta, min_value, value, iterations_with_no_improvement, epoch)"""
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    (magic, alpha_0, alpha, min_value, value, has_min_theta,
+     iterations_with_no_improvement, epoch, num_params, rng_version,
+     rng_length, has_rng_gauss, rng_gauss) = checkpoint_header.unpack_from(contents)
+    if magic != CHECKPOINT_MAGIC:
+        raise ValueError("%s is not a checkpoint file" % path)
+
+    offset = checkpoint_header.size
+    theta = list(struct.unpack_from('<%dd' % num_params, contents, offset))
+    offset += 8 * num_params
+    min_theta = list(struct.unpack_from('<%dd' % num_params, contents, offset))
+    offset += 8 * num_params
+    rng_internal = struct.unpack_from('<%dI' % rng_length, contents, offset)
+
+    random.setstate((rng_version, rng_internal,
+                     rng_gauss if has_rng_gauss else None))
+
+    return (alpha_0, theta, alpha, min_theta if has_min_theta else None,
+            min_value, value, iterations_with_no_improvement, epoch)
+
+def resume_stochastic(target_fn, gradient_fn, x, y, checkpoint_path,
+                      batch_size=None, callback=None, checkpoint_every=10):
+    """continue a minimize_stochastic run from its last checkpoint. x, y,
+    target_fn, gradient_fn and batch_size should be the same as the original"""
+    return minimize_stochastic(target_fn, gradient_fn, x, y, None,
+                               batch_size=batch_size, callback=callback,
+                               checkpoint_path=checkpoint_path,
+                               checkpoint_every=checkpoint_every, resume=True)
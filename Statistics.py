@@ -1,8 +1,95 @@
+# Every function in this chapter also accepts a Column, a compact container for big
+# columns of numbers that's explained in "Columns of Numbers" below. The functions
+# check for it from their very first example, so it has to be defined up front:
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from array import array
+
+class Column:
+    """a column of numbers stored as packed doubles"""
+
+    def __init__(self, values=()):
+        if np is not None:
+            self.values = np.asarray(values, dtype=float)
+        else:
+            self.values = array('d', values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def nbytes(self):
+        return len(self.values) * 8
+
+    def sum(self, accurate=False):
+        if np is None: return math.fsum(self.values)
+        if accurate: return accurate_sum(self.values)   # see "Summing Accurately"
+        return self.values.sum()
+
+    def mean(self, accurate=False):
+        return self.sum(accurate) / len(self)
+
+    def min(self):
+        return self.values.min() if np is not None else min(self.values)
+
+    def max(self):
+        return self.values.max() if np is not None else max(self.values)
+
+    def de_mean(self, accurate=False):
+        x_bar = self.mean(accurate)
+        if np is not None: return Column(self.values - x_bar)
+        return Column(x_i - x_bar for x_i in self.values)
+
+    def dot(self, other, accurate=False):
+        if np is not None:
+            if not accurate: return np.dot(self.values, other.values)
+            return accurate_sum(self.values * other.values)
+        return math.fsum(x_i * y_i for x_i, y_i in zip(self.values, other.values))
+
+    def variance(self, accurate=False):
+        deviations = self.de_mean(accurate)
+        return deviations.dot(deviations, accurate) / (len(self) - 1)
+
+    def covariance(self, other):
+        if not isinstance(other, Column): other = Column(other)
+        return self.de_mean().dot(other.de_mean()) / (len(self) - 1)
+
+    def quantile(self, p):
+        return select(self.values, int(p * len(self)))
+
+    def median(self):
+        n = len(self)
+        midpoint = n // 2
+        if n % 2 == 1:
+            return select(self.values, midpoint)
+        else:
+            lo, hi = select_many(self.values, [midpoint - 1, midpoint])
+            return (lo + hi) / 2
+
+    def mode(self):
+        if np is not None:
+            values, counts = np.unique(self.values, return_counts=True)
+            return list(values[counts == counts.max()])
+        counts = Counter(self.values)
+        max_count = max(counts.values())
+        return [x_i for x_i, count in counts.items() if count == max_count]
+
 ##Central Tendencies: Usually, we'll want some notion of where our data is centered. Most commonly we'll
 # use the mean (or average), which is just the sum of the data dividied by its count:
 
 # this isn't right if you don't from __future__ import division
-def mean(X):
+def mean(x, accurate=False):
+    if isinstance(x, Column): return x.mean(accurate)
+    if accurate: return accurate_sum(x) / len(x)    # see "Summing Accurately"
     return sum(x) / len(x)
 
 mean(num_friends)
@@ -25,6 +112,7 @@ mean(num_friends)
 
 def median(v):
     """finds the 'middle-most' value of v"""
+    if isinstance(v, Column): return v.median()
     n = len(v)
     sorted_v = sorted(v)
     midpoint = n // 2
@@ -58,6 +146,7 @@ def median(v):
 
 def quantile(x, p):
     """returns the pth-percentile value in x"""
+    if isinstance(x, Column): return x.quantile(p)
     p_index = int(p * len(x))
     return sorted(x)[p_index]
 
@@ -70,6 +159,7 @@ quantile(num_friends, 0.90)
 
 def mode(x):
     """returns a list, might be more than one mode"""
+    if isinstance(x, Column): return x.mode()
     counts = Counter(x)
     max_count = max(counts.values())
     return [x_i for x_i, count in counts.iteritems()
@@ -77,6 +167,101 @@ def mode(x):
 
 mode(num_friends)
 
+# mode needs a counter for every distinct value, which is a problem if there are
+# millions of distinct values (or if they keep streaming in). If we only care about
+# the most common values, the Space-Saving algorithm gets by with a fixed number
+# of counters. When a new value arrives and all the counters are taken, it
+# evicts the value with the smallest count and gives the new value that count
+# plus one (remembering that the count could be too high by that much).
+#
+# With capacity counters and n points, every count is at most n / capacity too
+# high, and any value that appears more than n / capacity times is guaranteed to
+# have a counter. Two sketches can be merged (Agarwal et al.): a value missing from
+# one of them could have occurred at most as often as that sketch's smallest count.
+
+import heapq
+
+class SpaceSaving:
+    """approximate counts of the most common values, using capacity counters"""
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.n = 0
+        self.counts = {}    # value -> count (possibly too high)
+        self.errors = {}    # value -> how much too high it could be
+        self.heap = []      # (count, tiebreaker, value), some out of date
+        self.pushes = 0     # used to break ties, so values never get compared
+
+    def push(self, value):
+        self.pushes += 1
+        heapq.heappush(self.heap, (self.counts[value], self.pushes, value))
+        if len(self.heap) > 2 * self.capacity + 100:
+            self.rebuild_heap()   # throw away the out-of-date entries
+
+    def rebuild_heap(self):
+        self.heap = [(count, i, value)
+                     for i, (value, count) in enumerate(self.counts.items())]
+        self.pushes = len(self.heap)
+        heapq.heapify(self.heap)
+
+    def min_count(self):
+        """the smallest count, or 0 if there are still free counters"""
+        if len(self.counts) < self.capacity:
+            return 0
+        while True:
+            count, _, value = self.heap[0]
+            if self.counts.get(value) == count:
+                return count
+            heapq.heappop(self.heap)   # out of date, so discard it
+
+    def add(self, x_i, count=1):
+        self.n += count
+        if x_i in self.counts:
+            self.counts[x_i] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[x_i], self.errors[x_i] = count, 0
+        else:
+            min_count = self.min_count()
+            _, _, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted], self.errors[evicted]
+            self.counts[x_i], self.errors[x_i] = min_count + count, min_count
+        self.push(x_i)
+
+    def add_all(self, x):
+        for x_i in x:
+            self.add(x_i)
+        return self
+
+    def merge(self, other):
+        min_self, min_other = self.min_count(), other.min_count()
+        counts, errors = {}, {}
+        for value in set(self.counts) | set(other.counts):
+            counts[value] = (self.counts.get(value, min_self) +
+                             other.counts.get(value, min_other))
+            errors[value] = (self.errors.get(value, min_self) +
+                             other.errors.get(value, min_other))
+
+        keep = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = { value : counts[value] for value in keep }
+        self.errors = { value : errors[value] for value in keep }
+        self.n += other.n
+        self.rebuild_heap()
+        return self
+
+    def most_common(self, num_values=None):
+        """(value, count, error) triples, most common first. the true count of
+        each value is between count - error and count"""
+        values = sorted(self.counts, key=self.counts.get, reverse=True)[:num_values]
+        return [(value, self.counts[value], self.errors[value]) for value in values]
+
+    def mode(self):
+        """returns a list, might be more than one (approximate) mode"""
+        max_count = max(self.counts.values())
+        return [x_i for x_i, count in self.counts.items()
+                if count == max_count]
+
+SpaceSaving(capacity=10).add_all(num_friends).mode()
+
 # But most frequently we'll just use the mean.
 
 ## Dispersion: Dispersion referes to measures of how spread out our data is. Typically
@@ -87,6 +272,7 @@ mode(num_friends)
 
 # "range" akready means something in Python, so we'll use a different name
 def data_range(x):
+    if isinstance(x, Column): return x.max() - x.min()
     return max(x) - min(x)
 
 data_range(num_friends)
@@ -102,15 +288,18 @@ data_range(num_friends)
 #
 # A more complex measure of dispersion is the variance, which is computed as:
 
-def de_mean(x):
+def de_mean(x, accurate=False):
     """translate x by subtracting its mean (so the result has mean 0)"""
-    x_bar = mean(x)
+    if isinstance(x, Column): return x.de_mean(accurate)
+    x_bar = mean(x, accurate)
     return [x_i - x_bar for x_i in x]
 
-def variance(x):
+def variance(x, accurate=False):
     """assumes x has at least two elements"""
+    if isinstance(x, Column): return x.variance(accurate)
     n = len(x)
-    deviations = de_mean(x)
+    deviations = de_mean(x, accurate)
+    if accurate: return accurate_sum_of_squares(deviations) / (n - 1)
     return sum_of_squares(deviations) / (n - 1)
 
 variance(num_friends)
@@ -121,8 +310,8 @@ variance(num_friends)
 # (e.g. "friends squared"). As it can be hard to make sense of these, we often look 
 # instead at the standard deviation.
 
-def standard_deviation(x):
-    return math.sqrt(variance(x))
+def standard_deviation(x, accurate=False):
+    return math.sqrt(variance(x, accurate))
 
 standard_deviation(num_friends)
 
@@ -140,6 +329,248 @@ interquartile_range(num_friends)
 
 # which is quite plainly unaffected by a small number of outliers.
 
+# Sorting is overkill for all of these, though. To find the kth smallest value we
+# don't need the data in order; we just need to know which points are smaller than
+# it. Quickselect finds it by picking a pivot, splitting the data into the points
+# less than, equal to, and greater than the pivot, and then repeating on whichever
+# piece contains the kth smallest. On average the pieces shrink geometrically, so
+# it takes O(n) time instead of the O(n log n) that sorting does.
+#
+# If we want several quantiles at once, we can split the list of ks the same way we
+# split the data, and only keep working on the pieces that still contain one of
+# them. (And in case we keep getting unlucky pivots, after enough rounds we give up
+# and sort what's left, which is what "introselect" does.)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def select_many(x, ks):
+    """returns the kth smallest (counting from 0) value of x for each k in ks"""
+    if np is not None and isinstance(x, np.ndarray):
+        partitioned = np.partition(x, ks)   # NumPy already implements introselect
+        return [partitioned[k] for k in ks]
+
+    results = {}
+    max_depth = 2 * max(1, len(x)).bit_length()
+    pending = [(list(x), 0, sorted(set(ks)), max_depth)]
+
+    while pending:
+        values, offset, wanted, depth = pending.pop()
+
+        if len(values) <= 32 or depth == 0:
+            values = sorted(values)
+            for k in wanted:
+                results[k] = values[k - offset]
+            continue
+
+        pivot = sorted(random.sample(values, 3))[1]   # median of three
+        less = [v for v in values if v < pivot]
+        greater = [v for v in values if v > pivot]
+        first_equal = offset + len(less)                  # position of first pivot
+        first_greater = offset + len(values) - len(greater)
+
+        for k in wanted:
+            if first_equal <= k < first_greater:
+                results[k] = pivot
+        left = [k for k in wanted if k < first_equal]
+        right = [k for k in wanted if k >= first_greater]
+        if left: pending.append((less, offset, left, depth - 1))
+        if right: pending.append((greater, first_greater, right, depth - 1))
+
+    return [results[k] for k in ks]
+
+def select(x, k):
+    """returns the kth smallest (counting from 0) value of x"""
+    return select_many(x, [k])[0]
+
+def quantiles(x, ps):
+    """returns the pth-percentile value in x for each p in ps"""
+    return select_many(x, [int(p * len(x)) for p in ps])
+
+def median_select(v):
+    """same as median, without sorting v"""
+    n = len(v)
+    midpoint = n // 2
+    if n % 2 == 1:
+        return select(v, midpoint)
+    else:
+        lo, hi = select_many(v, [midpoint - 1, midpoint])
+        return (lo + hi) / 2
+
+def interquartile_range_select(x):
+    q1, q3 = quantiles(x, [0.25, 0.75])
+    return q3 - q1
+
+quantiles(num_friends, [0.10, 0.25, 0.75, 0.90])
+
+# To see the difference, let's time the four quantiles above on a million points,
+# both with four calls to quantile (four sorts) and with one call to quantiles:
+
+import time
+
+random.seed(0)
+million = [random.random() for _ in range(1000000)]
+
+start = time.time()
+[quantile(million, p) for p in [0.10, 0.25, 0.75, 0.90]]
+sorting_seconds = time.time() - start
+
+start = time.time()
+quantiles(million, [0.10, 0.25, 0.75, 0.90])
+selection_seconds = time.time() - start
+
+sorting_seconds, selection_seconds
+
+# Both quantile and quantiles still need all of the data in memory at once, which
+# doesn't work for, say, response times that keep streaming in forever. In that
+# case we can settle for approximate quantiles from a sketch: a summary that has a
+# bounded size no matter how many points it's seen.
+#
+# The KLL sketch keeps a stack of "compactors." New points go into the bottom one.
+# When a compactor fills up, we sort it and keep every other point (randomly
+# either the odd ones or the even ones), and promote those to the compactor above,
+# where each point stands for twice as many original points. Lower compactors get
+# less room than higher ones, so the whole sketch holds about 3k points however
+# many it's seen. The rank of any value comes out within about 1.7/k of the
+# truth with high probability (for the default k = 200, under 1% of n in the
+# example below), and two sketches can be merged by merging their compactors
+# level by level, so each process can keep its own sketch and combine them later.
+
+import struct
+
+class KLLSketch:
+    """approximate quantiles of a stream in bounded memory"""
+
+    def __init__(self, k=200):
+        self.k = k
+        self.n = 0                  # how many points we've seen
+        self.compactors = [[]]
+        self.max_size = self.capacity(0)
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2.0 / 3) ** depth)) + 1
+
+    def size(self):
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(level)
+                            for level in range(len(self.compactors)))
+
+    def compress(self):
+        for level, compactor in enumerate(self.compactors):
+            if len(compactor) >= self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.grow()
+                compactor.sort()
+                # keep every other point, starting at a random one of the first two
+                self.compactors[level + 1].extend(compactor[random.randint(0, 1)::2])
+                self.compactors[level] = []
+                return
+
+    def add(self, x_i):
+        self.compactors[0].append(x_i)
+        self.n += 1
+        if self.size() >= self.max_size:
+            self.compress()
+
+    def add_all(self, x):
+        for x_i in x:
+            self.add(x_i)
+        return self
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.n += other.n
+        while self.size() >= self.max_size:
+            self.compress()
+        return self
+
+    def weighted_points(self):
+        """(value, weight) pairs in sorted order, where the weights sum to about n"""
+        return sorted((x_i, 2 ** level)
+                      for level, compactor in enumerate(self.compactors)
+                      for x_i in compactor)
+
+    def quantile(self, p):
+        """approximately the pth-percentile value"""
+        return self.quantiles([p])[0]
+
+    def quantiles(self, ps):
+        if self.n == 0:
+            raise ValueError("quantiles of an empty sketch")
+        points = self.weighted_points()
+        total_weight = sum(weight for _, weight in points)
+        results = []
+        for p in ps:
+            target, cumulative = p * total_weight, 0
+            for x_i, weight in points:
+                cumulative += weight
+                if cumulative > target:
+                    break
+            results.append(x_i)
+        return results
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def interquartile_range(self):
+        q1, q3 = self.quantiles([0.25, 0.75])
+        return q3 - q1
+
+    # The sketch is just a few small lists of floats, so it's easy to store or send
+    # to another process as bytes: a header, the length of each compactor, and then
+    # all of the values as doubles.
+
+    header = struct.Struct('<4sIIQ')
+
+    def to_bytes(self):
+        lengths = [len(compactor) for compactor in self.compactors]
+        values = [x_i for compactor in self.compactors for x_i in compactor]
+        return (self.header.pack(b'KLL1', self.k, len(lengths), self.n) +
+                struct.pack('<%dI' % len(lengths), *lengths) +
+                struct.pack('<%dd' % len(values), *values))
+
+    @classmethod
+    def from_bytes(cls, serialized):
+        magic, k, num_levels, n = cls.header.unpack_from(serialized)
+        if magic != b'KLL1':
+            raise ValueError("not a serialized KLLSketch")
+        offset = cls.header.size
+        lengths = struct.unpack_from('<%dI' % num_levels, serialized, offset)
+        offset += 4 * num_levels
+        values = struct.unpack_from('<%dd' % sum(lengths), serialized, offset)
+
+        sketch = cls(k)
+        sketch.n = n
+        sketch.compactors = []
+        for length in lengths:
+            sketch.compactors.append(list(values[:length]))
+            values = values[length:]
+        sketch.max_size = sum(sketch.capacity(level)
+                              for level in range(num_levels))
+        return sketch
+
+# For example, summarizing a million points with two sketches (as if on two
+# different machines) and combining them:
+
+random.seed(0)
+stream = [random.expovariate(1.0) for _ in range(1000000)]
+
+sketch1 = KLLSketch().add_all(stream[:500000])
+sketch2 = KLLSketch().add_all(stream[500000:])
+combined = KLLSketch.from_bytes(sketch1.to_bytes()).merge(sketch2)
+
+combined.quantiles([0.5, 0.9, 0.99]), quantiles(stream, [0.5, 0.9, 0.99])
+len(combined.to_bytes())
+
 ## Correlation: Datasciencester's VP of Growth has a theory that the amount of time 
 # people spend on the site is related to the number of friends they have on the site
 # (she's not a VP for nothing), and she's asked you to verify this.
@@ -154,6 +585,7 @@ interquartile_range(num_friends)
 # variables vary in tandem from their means:
 
 def covariance(x, y):
+    if isinstance(x, Column): return x.covariance(y)
     n = len(x)
     return dot(de_mean(x), de_mean(y)) / (n - 1)
 
@@ -222,3 +654,379 @@ correlation(num_friends_good, daily_minutes_good)
 # For example, imagine that you can identify all of your members as either East Coast
 # data scientists or West Coast data scientists. You decide to examine which coast's
 # data scientists are friendlier:
+
+
+## Summary Statistics in One Pass:
+# Each of the functions above makes its own pass (or several) over the data, and
+# correlation in particular computes both standard deviations (each of which calls
+# de_mean, which builds a whole new list) before calling covariance (which calls
+# de_mean twice more). That's fine for num_friends, but if the data is huge, or
+# doesn't fit in memory, or is streaming in, we'd rather look at each point once
+# and keep only a few running totals.
+#
+# The trick (due to Welford) is to keep track of the count, the mean, and the sum
+# of squared deviations from the mean, updating all three as each point arrives.
+# Even better, two sets of running totals (say, from two halves of the data) can be
+# merged into the totals for the whole thing (this is due to Chan et al.), which
+# lets us summarize shards of data separately and combine them afterward.
+
+class RunningStats:
+    """count, mean, variance, min and max of the points seen so far"""
+
+    def __init__(self):
+        self.n = 0
+        self.running_mean = 0.0
+        self.sum_squared_deviations = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, x_i):
+        self.n += 1
+        delta = x_i - self.running_mean
+        self.running_mean += delta / self.n
+        # uses the deviation from both the old and the new mean
+        self.sum_squared_deviations += delta * (x_i - self.running_mean)
+        if x_i < self.min: self.min = x_i
+        if x_i > self.max: self.max = x_i
+
+    def add_all(self, x):
+        for x_i in x:
+            self.add(x_i)
+        return self
+
+    def merge(self, other):
+        """fold the statistics from other into these ones"""
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.running_mean - self.running_mean
+        self.sum_squared_deviations += (other.sum_squared_deviations +
+                                        delta ** 2 * self.n * other.n / n)
+        self.running_mean += delta * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def mean(self):
+        return self.running_mean
+
+    def variance(self):
+        """assumes at least two points"""
+        return self.sum_squared_deviations / (self.n - 1)
+
+    def standard_deviation(self):
+        return math.sqrt(self.variance())
+
+    def data_range(self):
+        return self.max - self.min
+
+# The paired version does the same for x and y, and also keeps track of the sum of
+# the products of their deviations, which gives us covariance and correlation:
+
+class RunningCovariance:
+    """running statistics for each of x and y, plus their covariance"""
+
+    def __init__(self):
+        self.x = RunningStats()
+        self.y = RunningStats()
+        self.sum_products_of_deviations = 0.0
+
+    def add(self, x_i, y_i):
+        dx = x_i - self.x.running_mean    # deviation from the old mean of x
+        self.x.add(x_i)
+        self.y.add(y_i)
+        self.sum_products_of_deviations += dx * (y_i - self.y.running_mean)
+
+    def add_all(self, x, y):
+        for x_i, y_i in zip(x, y):
+            self.add(x_i, y_i)
+        return self
+
+    def merge(self, other):
+        n = self.x.n + other.x.n
+        if n > 0:
+            dx = other.x.running_mean - self.x.running_mean
+            dy = other.y.running_mean - self.y.running_mean
+            self.sum_products_of_deviations += (other.sum_products_of_deviations +
+                                                dx * dy * self.x.n * other.x.n / n)
+        self.x.merge(other.x)
+        self.y.merge(other.y)
+        return self
+
+    def covariance(self):
+        return self.sum_products_of_deviations / (self.x.n - 1)
+
+    def correlation(self):
+        stdev_x = self.x.standard_deviation()
+        stdev_y = self.y.standard_deviation()
+        if stdev_x > 0 and stdev_y > 0:
+            return self.covariance() / stdev_x / stdev_y
+        else:
+            return 0 # if no variation, correlation is zero
+
+# Since they work on any iterable, we can summarize data without ever having it all
+# in memory at once:
+
+stats = RunningStats().add_all(num_friends)
+stats.mean(), stats.standard_deviation(), stats.data_range()
+
+RunningCovariance().add_all(num_friends, daily_minutes).correlation()
+
+
+## Columns of Numbers:
+# A Python list of floats stores a pointer to a separate float object for each
+# element, which costs around 32 bytes per number and scatters the numbers all over
+# memory. For big data sets we can do much better by storing the numbers packed
+# together as raw doubles (8 bytes each), in a NumPy array if we have NumPy or in a
+# Python array('d') if we don't.
+#
+# A Column wraps such an array, and every function in this chapter checks for one
+# and hands the work off to it. With NumPy the work happens in vectorized (C-speed)
+# kernels, and nothing ever gets converted back into a list. Without NumPy we
+# still get the compact storage, but the arithmetic is ordinary Python. (The
+# class itself is at the top of the chapter. Its quantile and median use select
+# and select_many, which use np.partition on NumPy arrays; on an array('d') they
+# fall back to quickselect, which copies the values into a list as it goes.)
+#
+# To see what this buys us, let's compare a list and a Column of ten million
+# numbers. The list needs about 8 bytes for each pointer plus 24 for each float:
+
+import sys, time
+
+random.seed(0)
+ten_million = [random.random() for _ in range(10000000)]
+column = Column(ten_million)
+
+list_bytes = sys.getsizeof(ten_million) + len(ten_million) * sys.getsizeof(0.0)
+column_bytes = column.nbytes()
+list_bytes, column_bytes         # roughly 320MB vs 80MB
+
+for f in [mean, variance, standard_deviation, median]:
+    start = time.time()
+    f(ten_million)
+    list_seconds = time.time() - start
+
+    start = time.time()
+    f(column)
+    column_seconds = time.time() - start
+
+    print f.__name__, list_seconds, column_seconds
+
+## Using More Cores:
+# Since RunningStats and RunningCovariance can be merged, we can also split a big
+# column into chunks, summarize each chunk in a different process, and merge the
+# results. Because the merge formulas are exact, the answer is the same as if
+# we'd done it all in one pass (up to floating-point rounding).
+#
+# We don't want to pickle hundreds of millions of numbers to send them to each
+# worker, so we copy them once into shared memory, which every worker can read
+# directly. Each worker gets just the start and end of its chunk, and sends back a
+# handful of numbers. We merge the chunks' results pairwise (first neighbors, then
+# pairs of pairs, and so on), which keeps the rounding errors from piling up.
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+def to_shared_memory(x):
+    """copy x (a list or Column) into an array of doubles in shared memory"""
+    values = x.values if isinstance(x, Column) else x
+    shared = RawArray('d', len(values))
+    if np is not None:
+        np.frombuffer(shared, dtype=float)[:] = values
+    else:
+        shared[:] = values
+    return shared
+
+shared_columns = []   # filled in separately in each worker process
+
+def init_moments_worker(*columns):
+    shared_columns[:] = columns
+
+def chunk_stats(column, start, stop):
+    """RunningStats for column[start:stop], computed with two passes over it"""
+    stats = RunningStats()
+    if np is not None:
+        chunk = np.frombuffer(column, dtype=float)[start:stop]
+        stats.n = len(chunk)
+        stats.running_mean = chunk.mean()
+        stats.sum_squared_deviations = np.dot(chunk - stats.running_mean,
+                                              chunk - stats.running_mean)
+        stats.min, stats.max = chunk.min(), chunk.max()
+    else:
+        chunk = column[start:stop]
+        stats.n = len(chunk)
+        stats.running_mean = math.fsum(chunk) / len(chunk)
+        stats.sum_squared_deviations = math.fsum((x_i - stats.running_mean) ** 2
+                                                 for x_i in chunk)
+        stats.min, stats.max = min(chunk), max(chunk)
+    return stats
+
+def chunk_moments(bounds):
+    """the statistics for one chunk of each shared column (and, if there are
+    two columns, their covariance), as a tuple of plain numbers"""
+    start, stop = bounds
+    moments = []
+    for column in shared_columns:
+        stats = chunk_stats(column, start, stop)
+        moments.extend([stats.n, stats.running_mean, stats.sum_squared_deviations,
+                        stats.min, stats.max])
+
+    if len(shared_columns) == 2:
+        x_bar, y_bar = moments[1], moments[6]
+        x, y = shared_columns
+        if np is not None:
+            x = np.frombuffer(x, dtype=float)[start:stop]
+            y = np.frombuffer(y, dtype=float)[start:stop]
+            moments.append(np.dot(x - x_bar, y - y_bar))
+        else:
+            moments.append(math.fsum((x_i - x_bar) * (y_i - y_bar)
+                                     for x_i, y_i in zip(x[start:stop], y[start:stop])))
+    return tuple(moments)
+
+def stats_from_moments(moments):
+    stats = RunningStats()
+    (stats.n, stats.running_mean, stats.sum_squared_deviations,
+     stats.min, stats.max) = moments
+    return stats
+
+def merge_pairwise(summaries):
+    """merge a list of RunningStats (or RunningCovariances) like a tournament"""
+    while len(summaries) > 1:
+        summaries = [summaries[i].merge(summaries[i + 1])
+                     if i + 1 < len(summaries) else summaries[i]
+                     for i in range(0, len(summaries), 2)]
+    return summaries[0]
+
+def parallel_summary(x, y=None, num_workers=None, num_chunks=None):
+    """RunningStats for x (or RunningCovariance for x and y), computed in
+    num_chunks chunks on num_workers processes"""
+    num_workers = num_workers or multiprocessing.cpu_count()
+    num_chunks = num_chunks or 4 * num_workers
+    n = len(x)
+    num_chunks = max(1, min(num_chunks, n))
+    bounds = [(n * k // num_chunks, n * (k + 1) // num_chunks)
+              for k in range(num_chunks)]
+
+    columns = [to_shared_memory(x)] + ([to_shared_memory(y)] if y is not None else [])
+    pool = multiprocessing.Pool(num_workers, initializer=init_moments_worker,
+                                initargs=columns)
+    try:
+        chunk_results = pool.map(chunk_moments, bounds)
+    finally:
+        pool.close()
+        pool.join()
+
+    if y is None:
+        return merge_pairwise([stats_from_moments(moments)
+                               for moments in chunk_results])
+
+    summaries = []
+    for moments in chunk_results:
+        summary = RunningCovariance()
+        summary.x = stats_from_moments(moments[0:5])
+        summary.y = stats_from_moments(moments[5:10])
+        summary.sum_products_of_deviations = moments[10]
+        summaries.append(summary)
+    return merge_pairwise(summaries)
+
+def parallel_variance(x, num_workers=None):
+    return parallel_summary(x, num_workers=num_workers).variance()
+
+def parallel_covariance(x, y, num_workers=None):
+    return parallel_summary(x, y, num_workers=num_workers).covariance()
+
+def parallel_correlation(x, y, num_workers=None):
+    return parallel_summary(x, y, num_workers=num_workers).correlation()
+
+# Here's how long it takes with different numbers of workers. The timing loop only
+# runs in the main process. That matters on Windows, where every worker imports this
+# file to find chunk_moments, and so re-runs every example above, including
+# building the ten-million-number list. That costs each worker seconds of time and
+# hundreds of megabytes, which is exactly what the shared memory was meant to
+# save. So for real use, put parallel_summary and its helpers in a module of
+# their own:
+
+if __name__ == "__main__":
+    for num_workers in [1, 2, 4, 8]:
+        start = time.time()
+        parallel_variance(column, num_workers)
+        print num_workers, "workers:", time.time() - start, "seconds"
+
+
+## Summing Accurately:
+# Adding up floating-point numbers one at a time with sum rounds after every
+# addition, and the rounding errors can grow with the number of terms: summing
+# ten million values, the last few digits of a mean can easily be wrong, and
+# variance (which subtracts numbers that are close together) can lose many more.
+#
+# Python's math.fsum tracks the lost low-order bits in extra partial sums as it
+# goes, and returns the correctly rounded sum: the exact total, rounded once to
+# the nearest double. It makes a single pass and is written in C, but it's still
+# two or three times slower than sum, so it's not the default: passing
+# accurate=True to mean, de_mean, variance or standard_deviation turns it on.
+# (Plain NumPy sums use pairwise summation, which is already much better than
+# sum, with error that grows like log n rather than n.)
+#
+# Two-pass variance with a correctly rounded mean and a correctly rounded sum of
+# squares is accurate to within a few rounding errors of the squared deviations
+# themselves, however many points there are.
+#
+# fsum on a NumPy array (which is what a Column holds) has to turn every element
+# into a Python float first, which makes it slower still. Instead we can lay the
+# array out as rows of a few thousand "lanes" and add it up a row at a time with
+# vectorized operations, using Neumaier's compensated summation: each lane keeps
+# a running total plus a running correction that collects the low-order bits
+# each addition rounds away. At the end fsum adds up the few thousand totals and
+# corrections. The result is within about a rounding error of the true sum (in
+# practice it almost always is the correctly rounded sum). On ten million numbers
+# it's about seven times as fast as fsum on the same array, and twice as fast as
+# fsum on a list, though still several times slower than a plain NumPy sum.
+
+def compensated_sum(x, lanes=4096):
+    """very nearly the correctly rounded sum of x, a NumPy array"""
+    full = len(x) // lanes * lanes
+    if full == 0:
+        return math.fsum(x.tolist())
+    rows = x[:full].reshape(-1, lanes)
+    total = rows[0].copy()
+    correction = np.zeros(lanes)
+    for row in rows[1:]:
+        new_total = total + row
+        # the part of the smaller addend that didn't make it into new_total
+        correction += np.where(np.abs(total) >= np.abs(row),
+                               (total - new_total) + row,
+                               (row - new_total) + total)
+        total = new_total
+    return math.fsum(total.tolist() + correction.tolist() + x[full:].tolist())
+
+def accurate_sum(x):
+    """the correctly rounded sum of x (very nearly, if x is a NumPy array)"""
+    if np is not None and isinstance(x, np.ndarray):
+        return compensated_sum(x)
+    return math.fsum(x)
+
+def accurate_sum_of_squares(v):
+    if np is not None and isinstance(v, np.ndarray):
+        return compensated_sum(v * v)
+    return math.fsum(v_i ** 2 for v_i in v)
+
+# For example, a big number followed by lots of small ones:
+
+lopsided = [1e16] + [1.0] * 1000000
+
+sum(lopsided) - 1e16, accurate_sum(lopsided) - 1e16      # 0.0 vs 1000000.0
+
+start = time.time()
+mean(ten_million)
+fast_seconds = time.time() - start
+
+start = time.time()
+mean(ten_million, accurate=True)
+accurate_seconds = time.time() - start
+
+start = time.time()
+mean(column, accurate=True)
+column_accurate_seconds = time.time() - start
+
+fast_seconds, accurate_seconds, column_accurate_seconds
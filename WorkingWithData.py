@@ -37,6 +37,132 @@ def plot_histogram(points, bucket_size, title=""):
     plt.title(title)
     plt.show()
 
+# make_histogram starts from scratch every time, calls math.floor once per point,
+# and keys its Counter by floats. If the data keeps coming (or is spread across
+# several machines), we'd rather have a histogram we can keep adding points to,
+# and merge with other histograms.
+#
+# Since the buckets are evenly spaced, we can number them (bucket i holds the
+# points from i * bucket_size up to (i + 1) * bucket_size), and store the counts
+# in a compact array indexed by bucket number, growing it as needed. With NumPy,
+# we can find the bucket numbers for a whole array of points at once and count
+# them with bincount. And for data that's spread over several orders of magnitude
+# (like response times), we can use logarithmic buckets instead: bucket i holds
+# the points from log_base ** i up to log_base ** (i + 1).
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from array import array
+
+class Histogram:
+    """counts of points in numbered buckets, which can be added to and merged.
+    the counts are stored densely from the lowest bucket to the highest, so a
+    far-off outlier can't make more than max_buckets of them"""
+
+    def __init__(self, bucket_size=1.0, log_base=None, max_buckets=10 ** 7):
+        self.bucket_size = bucket_size
+        self.log_base = log_base
+        self.max_buckets = max_buckets
+        self.first_bucket = 0     # the bucket number that counts[0] counts
+        self.counts = np.zeros(0, dtype=np.int64) if np is not None else array('l')
+
+    def bucket_numbers(self, points):
+        if np is not None:
+            points = np.asarray(points, dtype=float)
+            if self.log_base is None:
+                return np.floor(points / self.bucket_size).astype(np.int64)
+            if (points <= 0).any():
+                raise ValueError("logarithmic buckets need positive points")
+            buckets = np.floor(np.log(points) / math.log(self.log_base)).astype(np.int64)
+            # the logarithm can round the wrong way right at a bucket edge
+            buckets += (self.log_base ** (buckets + 1.0) <= points)
+            buckets -= (self.log_base ** (buckets + 0.0) > points)
+            return buckets
+
+        if self.log_base is None:
+            return [int(math.floor(point / self.bucket_size)) for point in points]
+        return [self.log_bucket_number(point) for point in points]
+
+    def log_bucket_number(self, point):
+        if point <= 0:
+            raise ValueError("logarithmic buckets need positive points")
+        bucket = int(math.floor(math.log(point, self.log_base)))
+        # the logarithm can round the wrong way right at a bucket edge
+        if self.log_base ** (bucket + 1) <= point: bucket += 1
+        elif self.log_base ** bucket > point: bucket -= 1
+        return bucket
+
+    def bucket_edge(self, bucket):
+        """the lower edge of the given bucket"""
+        if self.log_base is None:
+            return bucket * self.bucket_size
+        return self.log_base ** bucket
+
+    def grow(self, lo, hi):
+        """make room in counts for buckets lo through hi"""
+        last_bucket = self.first_bucket + len(self.counts) - 1
+        if len(self.counts) == 0:
+            self.first_bucket, last_bucket = lo, lo - 1
+        before = max(0, self.first_bucket - lo)
+        after = max(0, hi - last_bucket)
+        if len(self.counts) + before + after > self.max_buckets:
+            raise ValueError("buckets %d through %d are more than max_buckets=%d; "
+                             "use a bigger bucket_size or log_base"
+                             % (min(lo, self.first_bucket), max(hi, last_bucket),
+                                self.max_buckets))
+        if np is not None:
+            self.counts = np.concatenate([np.zeros(before, dtype=np.int64),
+                                          self.counts,
+                                          np.zeros(after, dtype=np.int64)])
+        else:
+            self.counts = array('l', [0]) * before + self.counts + array('l', [0]) * after
+        self.first_bucket -= before
+
+    def add(self, points):
+        buckets = self.bucket_numbers(points)
+        if len(buckets) == 0:
+            return self
+        if np is not None:
+            lo, hi = int(buckets.min()), int(buckets.max())
+        else:
+            lo, hi = min(buckets), max(buckets)
+        self.grow(lo, hi)
+
+        if np is not None:
+            start = lo - self.first_bucket
+            self.counts[start:start + hi - lo + 1] += np.bincount(buckets - lo)
+        else:
+            for bucket in buckets:
+                self.counts[bucket - self.first_bucket] += 1
+        return self
+
+    def merge(self, other):
+        """add the counts from other, which must have the same kind of buckets"""
+        if (self.bucket_size, self.log_base) != (other.bucket_size, other.log_base):
+            raise ValueError("can only merge histograms with the same buckets")
+        if len(other.counts) == 0:
+            return self
+        self.grow(other.first_bucket, other.first_bucket + len(other.counts) - 1)
+        start = other.first_bucket - self.first_bucket
+        if np is not None:
+            self.counts[start:start + len(other.counts)] += other.counts
+        else:
+            for i, count in enumerate(other.counts):
+                self.counts[start + i] += count
+        return self
+
+    def items(self):
+        """(lower edge of bucket, count) for each non-empty bucket"""
+        return [(self.bucket_edge(self.first_bucket + i), int(count))
+                for i, count in enumerate(self.counts) if count > 0]
+
+    def to_counter(self):
+        """the same thing make_histogram returns"""
+        return Counter(dict(self.items()))
+
 # For example, consider the two following sets of data:
 
 random.seed(0)
@@ -111,6 +237,147 @@ def correlation_matrix(data):
 
     return make_matrix(num_columns, num_columns, matrix_entry)
 
+# That's fine for a handful of columns, but it's very wasteful: for every (i, j)
+# we extract both columns again, compute both standard deviations again (which
+# each de_mean the column again), and de_mean them both again for the covariance.
+# And we do all that twice for each pair (since the matrix is symmetric) plus once
+# more for each diagonal entry (which is always 1).
+#
+# Instead we can standardize each column once: subtract its mean and divide by
+# its length (as a vector), so that the correlation of two columns is just the
+# dot product of their standardized versions. Then the whole matrix is a single
+# matrix product, of which we only need to compute the upper triangle. With NumPy
+# we compute it a block of columns at a time, so the work goes to fast matrix
+# multiplication routines without the intermediate results getting too big.
+
+def standardized_columns(data):
+    """the columns of data, each with mean 0 and length 1 (or all zeros if the
+    column has no variation, since then its correlation with anything is 0)"""
+    columns = []
+    for j in range(shape(data)[1]):
+        deviations = de_mean(get_column(data, j))
+        length = math.sqrt(sum(d ** 2 for d in deviations))
+        columns.append([d / length if length > 0 else 0.0 for d in deviations])
+    return columns
+
+def fast_correlation_matrix(data, block_size=128):
+    """same as correlation_matrix, but standardizing each column only once"""
+    _, num_columns = shape(data)
+
+    if np is not None:
+        z = np.asarray(data, dtype=float)
+        z = z - z.mean(axis=0)
+        lengths = np.sqrt((z ** 2).sum(axis=0))
+        has_variation = lengths > 0
+        z[:, has_variation] /= lengths[has_variation]
+        z[:, ~has_variation] = 0
+
+        matrix = np.empty((num_columns, num_columns))
+        for i in range(0, num_columns, block_size):
+            for j in range(i, num_columns, block_size):
+                block = z[:, i:i + block_size].T.dot(z[:, j:j + block_size])
+                matrix[i:i + block_size, j:j + block_size] = block
+                matrix[j:j + block_size, i:i + block_size] = block.T
+        np.fill_diagonal(matrix, has_variation.astype(float))
+        return matrix.tolist()
+
+    columns = standardized_columns(data)
+    matrix = make_matrix(num_columns, num_columns, lambda i, j: 0.0)
+    for i in range(num_columns):
+        # correlation(x, x) is 1, unless x has no variation
+        matrix[i][i] = 1.0 if any(columns[i]) else 0.0
+        for j in range(i + 1, num_columns):
+            matrix[i][j] = matrix[j][i] = dot(columns[i], columns[j])
+    return matrix
+
+# If the rows keep arriving, we don't want to start over every time. Just like the
+# RunningCovariance we built for two variables, we can keep a running mean for each
+# column and a running sum of products of deviations for each pair of columns,
+# update them as rows come in, and merge them across shards:
+
+class RunningCorrelationMatrix:
+    """a correlation matrix that can be updated with new rows"""
+
+    def __init__(self, num_columns):
+        self.num_columns = num_columns
+        self.n = 0
+        self.means = [0.0] * num_columns
+        self.sums_of_products = make_matrix(num_columns, num_columns,
+                                            lambda i, j: 0.0)
+        if np is not None:
+            self.means = np.array(self.means)
+            self.sums_of_products = np.array(self.sums_of_products)
+
+    def add_rows(self, rows):
+        """update with a batch of rows (faster than one row at a time)"""
+        if np is not None:
+            rows = np.asarray(rows, dtype=float)
+            if len(rows) == 0:    # mean(axis=0) of no rows is nan
+                return self
+            batch = RunningCorrelationMatrix(self.num_columns)
+            batch.n = len(rows)
+            batch.means = rows.mean(axis=0)
+            deviations = rows - batch.means
+            batch.sums_of_products = deviations.T.dot(deviations)
+            return self.merge(batch)
+
+        for row in rows:
+            self.n += 1
+            deltas = [x_i - mean_i for x_i, mean_i in zip(row, self.means)]
+            self.means = [mean_i + delta_i / self.n
+                          for mean_i, delta_i in zip(self.means, deltas)]
+            for i in range(self.num_columns):
+                for j in range(self.num_columns):
+                    self.sums_of_products[i][j] += deltas[i] * (row[j] - self.means[j])
+        return self
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return self
+        if np is not None:
+            deltas = other.means - self.means
+            self.sums_of_products = (self.sums_of_products + other.sums_of_products +
+                                     np.outer(deltas, deltas) * self.n * other.n / n)
+            self.means = self.means + deltas * other.n / n
+        else:
+            deltas = [b - a for a, b in zip(self.means, other.means)]
+            for i in range(self.num_columns):
+                for j in range(self.num_columns):
+                    self.sums_of_products[i][j] += (other.sums_of_products[i][j] +
+                        deltas[i] * deltas[j] * self.n * other.n / n)
+            self.means = [a + delta * other.n / n
+                          for a, delta in zip(self.means, deltas)]
+        self.n = n
+        return self
+
+    def matrix(self):
+        lengths = [math.sqrt(self.sums_of_products[i][i])
+                   for i in range(self.num_columns)]
+
+        def matrix_entry(i, j):
+            if lengths[i] > 0 and lengths[j] > 0:
+                return self.sums_of_products[i][j] / lengths[i] / lengths[j]
+            else:
+                return 0 # if no variation, correlation is zero
+
+        return make_matrix(self.num_columns, self.num_columns, matrix_entry)
+
+# To compare them, let's time both versions on a data set with 500 columns. (The
+# original version computes 250,000 correlations, so this takes a while.)
+
+import time
+
+wide_data = [[random_normal() for _ in range(500)] for _ in range(100)]
+
+start = time.time()
+correlation_matrix(wide_data)
+print "correlation_matrix:", time.time() - start, "seconds"
+
+start = time.time()
+fast_correlation_matrix(wide_data)
+print "fast_correlation_matrix:", time.time() - start, "seconds"
+
 # A more visual approach (if you don't have too many dimensions) is to make a
 # scatterplot matrix (figure 10-4) showing all the pairwise scatterplots. To do
 # that we'll use plt.subplot(), which allows us to create subplots of our chart.
@@ -144,3 +411,100 @@ for i in range(num_columns):
     ax[0][0].set_ylim(ax[0][1].get_ylim())
 
     plt.show()
+
+## Plotting Lots of Data:
+# plot_histogram and the scatterplots above hand every point to matplotlib, which
+# draws a separate marker for each one. With millions of points that takes minutes
+# and gigabytes, and the result is mostly an indistinguishable blob anyway.
+#
+# Instead we can do the aggregating ourselves and give matplotlib a small, fixed
+# amount to draw regardless of how much data there is. For histograms, that means
+# handing it the already-counted buckets (merging neighboring buckets if there are
+# more than max_bars of them). For scatterplots, it means counting the points in
+# a bins x bins grid and drawing the counts as a single image, darker where there
+# are more points. None of this needs a screen, so it works fine with the Agg
+# backend (matplotlib.use('Agg')) followed by plt.savefig.
+
+def plot_binned_histogram(points, bucket_size, title="", max_bars=500, ax=None):
+    """like plot_histogram, but draws at most max_bars bars however many points"""
+    ax = ax or plt.gca()
+    histogram = Histogram(bucket_size).add(points)
+
+    # merge every `factor` neighboring buckets so there are at most max_bars
+    factor = max(1, int(math.ceil(len(histogram.counts) / float(max_bars))))
+    counts = histogram.counts
+    first_bucket = histogram.first_bucket - histogram.first_bucket % factor
+    merged = Counter()
+    for i, count in enumerate(counts):
+        if count:
+            merged[(histogram.first_bucket + i - first_bucket) // factor] += count
+
+    edges = [(first_bucket + i * factor) * bucket_size for i in merged]
+    ax.bar(edges, list(merged.values()), width=bucket_size * factor, align='edge')
+    ax.set_title(title)
+    return ax
+
+def density_scatter(xs, ys, bins=200, ax=None, cmap='Greys'):
+    """draw the points as one bins x bins image of counts instead of one
+    marker per point (empty cells are left blank)"""
+    ax = ax or plt.gca()
+    x_min, x_max, y_min, y_max = min(xs), max(xs), min(ys), max(ys)
+    x_width = (x_max - x_min) / float(bins) or 1.0
+    y_width = (y_max - y_min) / float(bins) or 1.0
+
+    if np is not None:
+        counts, _, _ = np.histogram2d(xs, ys, bins=bins,
+                                      range=[[x_min, x_min + bins * x_width],
+                                             [y_min, y_min + bins * y_width]])
+        image = np.where(counts.T > 0, counts.T, np.nan)
+    else:
+        image = make_matrix(bins, bins, lambda i, j: 0)
+        for x, y in zip(xs, ys):
+            column = min(int((x - x_min) / x_width), bins - 1)
+            row = min(int((y - y_min) / y_width), bins - 1)
+            image[row][column] += 1
+        image = [[count if count > 0 else float('nan') for count in row]
+                 for row in image]
+
+    ax.imshow(image, origin='lower', aspect='auto', cmap=cmap,
+              interpolation='nearest',
+              extent=[x_min, x_min + bins * x_width, y_min, y_min + bins * y_width])
+    return ax
+
+def density_scatter_matrix(data, bins=100):
+    """the scatterplot matrix from above, but with density_scatter in each cell"""
+    _, num_columns = shape(data)
+    fig, ax = plt.subplots(num_columns, num_columns)
+
+    for i in range(num_columns):
+        for j in range(num_columns):
+
+            # column_j on the x-axis vs column_i on the y-axis
+            if i != j: density_scatter(get_column(data, j), get_column(data, i),
+                                       bins=bins, ax=ax[i][j])
+
+            # unless i == j, in which case show the series name
+            else: ax[i][j].annotate("series " + str(i), (0.5, 0.5),
+                                    xycoords='axes fraction',
+                                    ha="center", va="center")
+
+            # then hide axis labels except left and bottom charts
+            if i < num_columns - 1: ax[i][j].xaxis.set_visible(False)
+            if j > 0: ax[i][j].yaxis.set_visible(False)
+
+    return fig, ax
+
+# For example, with a million points from each of our two joint distributions:
+
+big_xs = [random_normal() for _ in range(1000000)]
+big_ys1 = [ x + random_normal() / 2 for x in big_xs]
+big_ys2 = [ -x + random_normal() / 2 for x in big_xs]
+
+density_scatter(big_xs, big_ys1, cmap='Greys')
+density_scatter(big_xs, big_ys2, cmap='Blues')
+plt.title("Very Different Joint Distributions (Density)")
+plt.savefig('joint_distributions.png')
+plt.clf()
+
+plot_binned_histogram(big_ys1, 0.01, "ys1 Histogram")
+plt.savefig('ys1_histogram.png')